@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Compare the sweep EndStartScheduler against the search based reference
+implementation on a window of a pass database.
+
+Both must give the same calendars, the script exits with 1 if they don't.
+"""
+
+import sys
+import time
+
+from satbazaar import db
+from satbazaar import client
+from satbazaar import schedulers
+
+
+###########################################################
+#
+# Configuration
+
+dbfile = 'passes_2018-08-16.sqlite'
+
+start = '2018-08-16'
+# the reference scheduler is quadratic, keep the window short
+end = '2018-08-17'
+
+# TODO: convert to argparse or other better CLI args system
+if len(sys.argv) == 4:
+    dbfile = sys.argv[1]
+    start = sys.argv[2]
+    end = sys.argv[3]
+
+#
+# end configuration variables
+#
+###########################################################
+
+
+stations = db.load_stations()
+sats = db.load_satellites()
+passes = db.getpasses(dbfile, start=start, end=end)
+print(len(passes), 'passes')
+
+line = '-- %-30s %8.3f s  %5i accepted'
+
+results = {}
+for sch in (schedulers.EndStartSearchScheduler, schedulers.EndStartScheduler):
+    clients = {name: client.YesClient(gs) for name, gs in stations.items()}
+    t = time.time()
+    sch(clients, sats, passes=passes)
+    elapsed = time.time() - t
+
+    results[sch.__name__] = {
+        name: sorted((iv.begin, iv.end) for iv in c.calendar)
+        for name, c in clients.items()}
+    accepted = sum(len(c.calendar) for c in clients.values())
+    print(line % (sch.__name__, elapsed, accepted))
+
+if len(set(map(repr, results.values()))) == 1:
+    print('-- calendars are identical')
+    sys.exit(0)
+else:
+    print('-- CALENDARS DIFFER')
+    sys.exit(1)
@@ -8,6 +8,7 @@ import time
 import cProfile
 
 from satbazaar import db
+from satbazaar import fastpass
 
 
 
@@ -23,13 +24,23 @@ dbfile = 'passes_2018-08-16.sqlite'
 
 compute_function = db.compute_passes_ephem
 # compute_function = db.compute_passes_orbital
+# compute_function = fastpass.compute_passes_numpy
+
+# one job per satellite against all stations
+# (not supported by compute_passes_orbital)
+per_satellite = True
+
+# only recompute pairs whose TLE or station changed and extend the rest to
+# the new horizon, instead of rebuilding dbfile from scratch
+incremental = False
 
 start_time = '2018/8/16 00:00:00'
 # duration = 8760 #a year worth of hours
 # duration = 24*90
 duration = 24*3
 
-num_processes = 1
+# None uses os.cpu_count() processes, 1 runs in this process
+num_processes = None
 
 # TODO: convert to argparse or other better CLI args system
 print(sys.argv)
@@ -75,14 +86,26 @@ print(line % 'Computing passes')
 
 #pr = cProfile.Profile()
 #pr.enable()
-tree = db.compute_all_passes(
+if incremental:
+    db.update_passes(
+                          stations.values(),
+                          sats.values(),
+                          start_time,
+                          duration=duration,
+                          passes_db=dbfile,
+                          num_processes=num_processes,
+                          compute_function=compute_function)
+    tree = None
+else:
+    tree = db.compute_all_passes(
                           iter(stations.values()),
                           iter(sats.values()),
                           start_time,
                           duration=duration,
                           passes_db=dbfile,
                           num_processes=num_processes,
-                          compute_function=compute_function)
+                          compute_function=compute_function,
+                          per_satellite=per_satellite)
 #pr.disable()
 #pr.print_stats(sort='time')
 # give the filesystem some time to finish closing the database file
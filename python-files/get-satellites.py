@@ -57,6 +57,15 @@ cur.execute('''CREATE TABLE IF NOT EXISTS tle
              downloaded timestamp,
              unique(norad, epoch)
             );''')
+# db.load_satellites() looks up the latest TLE of each satellite
+cur.execute('''CREATE INDEX IF NOT EXISTS idx_tle_norad_downloaded
+            ON tle (norad, downloaded DESC);''')
+
+# fetch all TLEs up front, requests to the API run concurrently and the
+# remaining satellites fall through to the other sources in bulk
+active = [norad for norad, sat in satellites.items()
+          if sat['status'] != 're-entered']
+tles = tle_source.get_many(active)
 
 UPDATED = 0
 for norad, sat in satellites.items():
@@ -66,14 +75,8 @@ for norad, sat in satellites.items():
             print(norad, 'has re-entered')
         continue
 
-    # TLESource lazily fetches TLEs only when requested.
-    # using catching the KeyError is faster than (norad in tle_source)
-    #
-    # vvv ensure we don't use a tle from the previous loop
-    tle = None
-    try:
-        tle = tle_source[norad]
-    except KeyError:
+    tle = tles.get(norad)
+    if tle is None:
         if DO_PRINT:
             print('{} no TLE'.format(norad))
         continue
@@ -0,0 +1,323 @@
+"""`adaptivepass` -- Pass search with an adaptive time step
+==========================================================
+
+PyEphem based pass finder which, instead of libastro's fixed steps of 2
+degrees of orbit, jumps ahead as far as the geometry allows:
+
+1. From the satellite's current angle from the station at the center of the
+   Earth, and the fastest the sub-satellite point can move for this orbit,
+   compute the earliest time the satellite could come above (or go below)
+   `min_horizon`, and step straight there.
+2. A sign change of (elevation - min_horizon) between two steps brackets a
+   rise or set, which is refined with regula falsi (Illinois variant).
+3. The highest elevation is found with a golden-section search between rise
+   and set.
+
+Far from the station the steps are long, near the horizon they shrink to
+MIN_STEP_DEGREES of orbit.  The number of propagations is counted so the
+savings can be checked:
+
+    stats = {}
+    passes = find_passes(stations, satellite, start_time, duration=24,
+                         stats=stats)
+    stats['propagations'] / stats['passes']
+
+`compute_passes_adaptive()` is a drop-in `compute_function` for
+`db.compute_all_passes()`.
+"""
+from collections.abc import Mapping
+from math import acos, cos, exp, pi, radians, sin, sqrt
+
+import ephem
+
+from satbazaar import visibility
+from satbazaar.db import TLE, PassTuple
+
+
+# shortest step, in degrees of orbit
+MIN_STEP_DEGREES = 1.0
+
+# degrees of slack on the reach of the station, for the spherical Earth and
+# geodetic latitude
+REACH_MARGIN = 1.0
+
+# headroom on the fastest motion of the sub-satellite point, for the
+# perturbations SGP4 adds to the mean elements, relative and in degrees per
+# day so it holds for geostationary orbits too
+RATE_MARGIN = 1.1
+RATE_FLOOR = 5.0
+
+# days past the end of the window to wait for a pass to set
+MAX_PASS_DAYS = 1.0
+
+# rise/set times are refined to this tolerance, in days (0.01 seconds)
+TIME_TOLERANCE = 0.01 / 86400
+# and the time of the highest elevation to this one (0.5 seconds)
+TCA_TOLERANCE = 0.5 / 86400
+
+# radians per day the Earth turns
+EARTH_ROTATION = 2 * pi * visibility.SIDEREAL_DAY_REVS
+
+deg_per_rad = 180.0 / pi
+
+
+def _root(f, a, fa, b, fb, tol=TIME_TOLERANCE):
+    """Zero of f in [a, b] where fa and fb have opposite signs.
+
+    Regula falsi with the Illinois modification, stepping at least tol/2
+    away from the ends and falling back to bisection if the bracket stops
+    shrinking.
+    """
+    side = 0
+    while b - a > tol:
+        width = b - a
+        c = b - fb * (b - a) / (fb - fa)
+        c = min(max(c, a + tol / 2), b - tol / 2)
+        fc = f(c)
+        if (fc >= 0) == (fb >= 0):
+            b, fb = c, fc
+            if side == -1:
+                fa /= 2
+            side = -1
+        else:
+            a, fa = c, fc
+            if side == 1:
+                fb /= 2
+            side = 1
+        if b - a > width / 2:
+            # slow progress, bisect once
+            m = (a + b) / 2
+            fm = f(m)
+            if (fm >= 0) == (fb >= 0):
+                b, fb = m, fm
+            else:
+                a, fa = m, fm
+            side = 0
+    return (a + b) / 2
+
+
+def _golden_max(f, a, b, tol=TCA_TOLERANCE):
+    """Argument of the maximum of the unimodal f in [a, b]."""
+    g = (sqrt(5) - 1) / 2
+    c = b - g * (b - a)
+    d = a + g * (b - a)
+    fc, fd = f(c), f(d)
+    while b - a > tol:
+        if fc > fd:
+            b, d, fd = d, c, fc
+            c = b - g * (b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + g * (b - a)
+            fd = f(d)
+    return (a + b) / 2
+
+
+def ground_rate(orbit, inclination):
+    """Upper bound on how fast the sub-satellite point moves over the
+    ground, in radians per day.
+
+    The direction to the satellite turns at the angular rate of the orbit,
+    about the orbit normal, which is fastest at perigee and slowest at
+    apogee; less the Earth's rotation about its axis.  The difference of the
+    two rotation vectors is largest at one of the two extremes.
+
+    inclination -- degrees, as in the TLE so retrograde orbits are > 90
+    """
+    a = (orbit.perigee + orbit.apogee) / 2
+    e = orbit.eccentricity
+    n = sqrt(visibility.EARTH_MU / a**3) * 86400
+    cos_i = cos(radians(inclination))
+    rate = 0.0
+    for theta_dot in (n * (1 + e)**2 / (1 - e**2)**1.5,
+                      n * (1 - e)**2 / (1 - e**2)**1.5):
+        rate = max(rate, sqrt(max(0.0, theta_dot**2 + EARTH_ROTATION**2
+                                  - 2 * theta_dot * EARTH_ROTATION * cos_i)))
+    return RATE_MARGIN * rate + radians(RATE_FLOOR)
+
+
+def relative_speed(orbit):
+    """Upper bound on the speed of the satellite relative to a station in
+    km/s, the orbital speed at perigee plus the station's rotation."""
+    a = (orbit.perigee + orbit.apogee) / 2
+    e = orbit.eccentricity
+    v = sqrt(visibility.EARTH_MU * (1 + e) / (a * (1 - e)))
+    return RATE_MARGIN * (v + EARTH_ROTATION / 86400 * visibility.EARTH_RADIUS)
+
+
+class _Search:
+    """Pass search of one satellite over one station, times are ephem.date
+    floats."""
+    def __init__(self, body, observer, orbit, inclination, stats):
+        self.body = body
+        self.observer = observer
+        self.stats = stats
+
+        gs = ephem.Observer()
+        gs.name = observer['name']
+        gs.lon = str(observer['lon'])
+        gs.lat = str(observer['lat'])
+        gs.elevation = observer['altitude']
+        gs.pressure = 0  # ignore atmospheric refraction at the horizon
+        gs.horizon = 0
+        self.gs = gs
+        self.lat = radians(float(observer['lat']))
+        self.lon = radians(float(observer['lon']))
+        self.horizon = radians(float(observer['min_horizon']))
+
+        r = visibility.station_radius(observer)
+        min_el = float(observer['min_horizon'])
+        margin = radians(REACH_MARGIN)
+        # central angles within which the satellite may be up, and within
+        # which it is sure to be up
+        self.reach_far = radians(visibility.max_central_angle(
+            orbit.apogee, r, min_el)) + margin
+        self.reach_near = radians(visibility.max_central_angle(
+            orbit.perigee, r, min_el)) - margin
+
+        self.rate = ground_rate(orbit, inclination)
+        self.speed = relative_speed(orbit)
+        n = sqrt(visibility.EARTH_MU / ((orbit.perigee + orbit.apogee) / 2)**3)
+        self.min_step = MIN_STEP_DEGREES / 360 * 2 * pi / (n * 86400)
+
+    def look(self, t):
+        """(elevation - min_horizon, central angle, range) at time t, in
+        radians and km.  The body is left computed at t."""
+        self.gs.date = t
+        self.body.compute(self.gs)
+        self.stats['propagations'] = self.stats.get('propagations', 0) + 1
+        b = self.body
+        psi = acos(max(-1.0, min(1.0,
+            sin(self.lat) * sin(b.sublat)
+            + cos(self.lat) * cos(b.sublat) * cos(b.sublong - self.lon))))
+        return b.alt - self.horizon, psi, b.range / 1000
+
+    def elevation(self, t):
+        return self.look(t)[0]
+
+    def step(self, f, psi, distance):
+        """Time to the next sample, as long as the satellite can't cross
+        the horizon before it.
+
+        Two bounds, the longer one wins: the central angle left to the edge
+        of the station's reach over the ground rate, and the elevation left
+        to min_horizon at the fastest the line of sight can turn, which is
+        the relative speed over a range shrinking at that speed.
+        """
+        if f < 0:
+            angle = psi - self.reach_far
+        else:
+            angle = self.reach_near - psi
+        ground = angle / self.rate
+        sight = distance * (1 - exp(-abs(f))) / self.speed / 86400
+        return max(self.min_step, ground, sight)
+
+    def passes(self, start, end, max_passes=None):
+        """(rise, set) times of the passes rising in [start, end]."""
+        found = []
+        # a pass in progress at start is skipped, as in the other finders
+        rise = None
+        try:
+            t = start
+            f, psi, distance = self.look(t)
+            while max_passes is None or len(found) < max_passes:
+                # keep going past the window only to close a pass which rose
+                # in it, and not forever for one that doesn't set
+                if t > end and (rise is None or t - end > MAX_PASS_DAYS):
+                    break
+                t_next = t + self.step(f, psi, distance)
+                f_next, psi_next, distance_next = self.look(t_next)
+                if (f < 0) != (f_next < 0):
+                    tx = _root(self.elevation, t, f, t_next, f_next)
+                    if f < 0:
+                        if tx > end:
+                            break
+                        rise = tx
+                    elif rise is not None:
+                        found.append((rise, tx))
+                        rise = None
+                t, f, psi, distance = t_next, f_next, psi_next, distance_next
+        except (RuntimeError, ValueError):
+            # decayed, or too far from the TLE epoch for ephem
+            pass
+        return found
+
+    def describe(self, rise, fall, satellite):
+        """PassTuple of a pass."""
+        tca = _golden_max(self.elevation, rise, fall)
+        azimuths = []
+        for t in (rise, fall, tca):
+            self.look(t)
+            azimuths.append(self.body.az)
+        rise_dt = ephem.date(rise).datetime()
+        fall_dt = ephem.date(fall).datetime()
+        return PassTuple(
+            start=rise_dt,
+            end=fall_dt,
+            duration=(fall_dt - rise_dt).total_seconds(),
+            rise_az=azimuths[0] * deg_per_rad,
+            set_az=azimuths[1] * deg_per_rad,
+            tca=ephem.date(tca).datetime(),
+            max_el=self.body.alt * deg_per_rad,
+            gs=self.observer['name'],
+            norad=satellite['norad_cat_id'])
+
+
+def find_passes(observers, satellite, start_time, num_passes=None,
+                duration=None, stats=None):
+    """Return a list of PassTuple for one satellite over many stations.
+
+    Arguments are as for fastpass.find_passes().  `stats`, if given, is a
+    dict in which the number of 'propagations' and 'passes' are counted.
+
+    Only passes which rise inside the window are returned, a pass already
+    in progress at `start_time` is skipped.
+    """
+    if stats is None:
+        stats = {}
+    if duration is None and num_passes is None:
+        duration = 24
+    start = float(ephem.date(start_time))
+    if duration is None:
+        # longer than suggested length for TLEs
+        end = start + 5 * 365
+    else:
+        end = start + duration / 24
+
+    body = ephem.readtle(*satellite['tle'])
+    orbit = visibility.orbit_summary(satellite['tle'])
+    inclination = TLE(satellite['tle']).inclination
+
+    data = []
+    for observer in observers:
+        search = _Search(body, observer, orbit, inclination, stats)
+        found = search.passes(start, end, num_passes)
+        data.extend(search.describe(rise, fall, satellite)
+                    for rise, fall in found)
+    stats['passes'] = stats.get('passes', 0) + len(data)
+    return data
+
+
+def compute_passes_adaptive(args):
+    """Config obs and sat, Return pass data for all passes in given interval.
+    uses PyEphem with an adaptive step
+
+    Drop-in replacement for db.compute_passes_ephem().  `observer` may also
+    be a sequence of station dicts.
+
+    Arguments:
+    observer -- station dict or sequence of station dicts
+    tle -- 3 element list containing desired tle [line0,line1,line2]
+    start_time -- ephem.date string formatted 'yyyy/mm/dd hr:min:sec'
+    num_passes -- integer number of desired passes (defualt None)
+    duration -- float number of hours or fraction of hours (default None)
+    """
+    (observer, satellite, start_time, num_passes, duration) = args
+    if isinstance(observer, Mapping):
+        observers = [observer]
+    else:
+        observers = list(observer)
+
+    return find_passes(observers, satellite, start_time,
+                       num_passes=num_passes, duration=duration)
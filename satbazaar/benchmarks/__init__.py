@@ -0,0 +1,13 @@
+"""`benchmarks` -- Repeatable performance numbers
+================================================
+
+Times the pass finders, the pass database, the schedulers and the client
+queries on synthetic stations and TLEs generated offline, so runs are
+repeatable and need no network.
+
+    python -m satbazaar.benchmarks run -o before.json
+    python -m satbazaar.benchmarks run -o after.json
+    python -m satbazaar.benchmarks compare before.json after.json
+
+See `python -m satbazaar.benchmarks run --help` for the fixture size.
+"""
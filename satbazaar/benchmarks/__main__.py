@@ -0,0 +1,195 @@
+"""Command line of the benchmarks, see the package docstring."""
+import argparse
+import contextlib
+from datetime import datetime
+import gc
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from satbazaar import db
+from satbazaar.benchmarks.cases import GROUPS, Skip
+from satbazaar.benchmarks.fixtures import Fixture
+
+
+def timeit(function, repeat):
+    """List of the run times of `repeat` calls in seconds.  Anything the
+    function prints is discarded."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - t)
+    return times
+
+
+def git_revision():
+    """Commit of the working tree, None outside of a git checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(__file__)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Build the fixture, time every selected case and write the results."""
+    params = {
+        'processes': args.processes,
+        'queries': args.queries,
+        'repeat': args.repeat,
+        'seed': args.seed,
+    }
+    only = re.compile(args.only) if args.only else None
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        print('-- building fixture in', workdir, file=sys.stderr)
+        fx = Fixture(workdir, args.stations, args.satellites, args.hours,
+                     args.start_time, args.seed)
+
+        results = {}
+        for group in GROUPS:
+            for name, function, size in group(fx, params):
+                if only is not None and not only.search(name):
+                    continue
+                result = results[name] = {'size': size}
+                if isinstance(function, Skip):
+                    result['skipped'] = function.reason
+                    print('%-45s skipped, %s' % (name, function.reason),
+                          file=sys.stderr)
+                    continue
+                try:
+                    times = timeit(function, args.repeat)
+                except Exception as e:
+                    result['error'] = repr(e)
+                    print('%-45s ERROR %r' % (name, e), file=sys.stderr)
+                    continue
+                result.update(min=min(times),
+                              median=statistics.median(times),
+                              mean=statistics.mean(times),
+                              times=times)
+                print('%-45s %10.4f s' % (name, min(times)), file=sys.stderr)
+        db.connections.close()
+
+    report = {
+        'meta': {
+            'date': datetime.utcnow().isoformat(),
+            'git': git_revision(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'fixture': fx.params(),
+            'params': params,
+        },
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=1)
+    return 0
+
+
+def compare(args):
+    """Print the cases of two results files side by side and return 1 if
+    any got slower by more than the threshold."""
+    with open(args.old) as fp:
+        old = json.load(fp)
+    with open(args.new) as fp:
+        new = json.load(fp)
+
+    for key in ('fixture', 'params'):
+        if old['meta'].get(key) != new['meta'].get(key):
+            print('!! %s differ: %s vs %s'
+                  % (key, old['meta'].get(key), new['meta'].get(key)))
+
+    line = '%-45s %10s %10s %7s  %s'
+    print(line % ('case', 'old s', 'new s', 'ratio', ''))
+    regressions = 0
+    names = list(old['results'])
+    names += [name for name in new['results'] if name not in old['results']]
+    for name in names:
+        a = old['results'].get(name)
+        b = new['results'].get(name)
+        if a is None or b is None:
+            print(line % (name, '', '', '', 'new' if a is None else 'removed'))
+            continue
+        if 'min' not in a or 'min' not in b:
+            note = (b.get('error') or b.get('skipped')
+                    or a.get('error') or a.get('skipped'))
+            print(line % (name, '', '', '', note))
+            continue
+        ratio = b['min'] / a['min'] if a['min'] > 0 else float('inf')
+        flag = ''
+        if (ratio > 1 + args.threshold
+                and b['min'] - a['min'] > args.min_time):
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 / (1 + args.threshold):
+            flag = 'faster'
+        print('%-45s %10.4f %10.4f %7.2f  %s'
+              % (name, a['min'], b['min'], ratio, flag))
+
+    print('-- %i regressions' % regressions)
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m satbazaar.benchmarks',
+        description='Time satbazaar on synthetic data.')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('run', help='run the benchmarks')
+    p.add_argument('-o', '--output', default='-',
+                   help='JSON results file (default: stdout)')
+    p.add_argument('--stations', type=int, default=10)
+    p.add_argument('--satellites', type=int, default=20)
+    p.add_argument('--hours', type=float, default=24,
+                   help='length of the pass window')
+    p.add_argument('--start-time', default='2018/8/16 00:00:00')
+    p.add_argument('--processes', default=[1, 2, 4],
+                   type=lambda s: [int(n) for n in s.split(',')],
+                   help='process counts for compute_all_passes, '
+                        'comma separated (default: 1,2,4)')
+    p.add_argument('--queries', type=int, default=1000,
+                   help='windows per client for the client queries')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--only', help='regex selecting the cases to run')
+    p.add_argument('--workdir',
+                   help='keep the databases here instead of a temporary '
+                        'directory')
+    p.set_defaults(func=run)
+
+    p = sub.add_parser('compare', help='compare two results files')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='relative slowdown counted as a regression '
+                        '(default: 0.1)')
+    p.add_argument('--min-time', type=float, default=0.001,
+                   help='ignore slowdowns smaller than this many seconds '
+                        '(default: 0.001)')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
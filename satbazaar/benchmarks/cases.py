@@ -0,0 +1,281 @@
+"""The benchmark cases.
+
+Each group is a generator taking the Fixture and the run parameters and
+yielding (name, function, size) with `function` the zero argument callable
+to time and `size` the number of items it handles.  Anything done before
+the yield is setup and isn't timed.  A case which can't run here yields a
+Skip in place of the function.
+"""
+from datetime import timedelta
+import importlib.util
+import itertools
+import os
+import random
+import sqlite3
+
+from satbazaar import adaptivepass, client, db, schedulers
+
+
+class Skip:
+    """Placeholder for a case which can't run, with the reason why."""
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def _missing(module):
+    if importlib.util.find_spec(module) is None:
+        return Skip('%s is not installed' % module)
+    return None
+
+
+def _jobs(observers, satellites, fx):
+    return [(o, s, fx.start_time, None, fx.hours)
+            for o, s in itertools.product(observers, satellites)]
+
+
+def engines(fx, params):
+    """Pass finders, one job per pair and one per satellite."""
+    stations = list(fx.stations.values())
+    satellites = list(fx.satellites.values())
+    pairs = _jobs(stations, satellites, fx)
+    per_satellite = _jobs([stations], satellites, fx)
+
+    def run(function, jobs):
+        return lambda: [function(job) for job in jobs]
+
+    yield ('engines.ephem', run(db.compute_passes_ephem, pairs), len(pairs))
+    yield ('engines.ephem_per_satellite',
+           run(db.compute_passes_ephem, per_satellite), len(per_satellite))
+    yield ('engines.adaptive',
+           run(adaptivepass.compute_passes_adaptive, pairs), len(pairs))
+    yield ('engines.adaptive_per_satellite',
+           run(adaptivepass.compute_passes_adaptive, per_satellite),
+           len(per_satellite))
+
+    skip = _missing('pyorbital')
+    yield ('engines.orbital',
+           skip or run(db.compute_passes_orbital, pairs), len(pairs))
+
+    skip = _missing('sgp4')
+    if skip is None:
+        from satbazaar import fastpass
+        yield ('engines.numpy',
+               run(fastpass.compute_passes_numpy, pairs), len(pairs))
+        yield ('engines.numpy_per_satellite',
+               run(fastpass.compute_passes_numpy, per_satellite),
+               len(per_satellite))
+    else:
+        yield 'engines.numpy', skip, len(pairs)
+        yield 'engines.numpy_per_satellite', skip, len(per_satellite)
+
+
+def compute_all_passes(fx, params):
+    """The whole computation into a new database, per process count, and
+    without the visibility prefilter."""
+    npairs = len(fx.stations) * len(fx.satellites)
+    for n in params['processes']:
+        passes_db = os.path.join(fx.directory, 'allpasses-%i.sqlite' % n)
+
+        def run(n=n, passes_db=passes_db):
+            db.compute_all_passes(fx.stations.values(),
+                                  fx.satellites.values(),
+                                  fx.start_time,
+                                  passes_db=passes_db,
+                                  duration=fx.hours,
+                                  num_processes=n,
+                                  per_satellite=True,
+                                  return_tree=False)
+
+        yield 'compute_all_passes.processes_%i' % n, run, npairs
+
+    def run():
+        db.compute_all_passes(fx.stations.values(),
+                              fx.satellites.values(),
+                              fx.start_time,
+                              passes_db=os.path.join(fx.directory,
+                                                     'allpasses-all.sqlite'),
+                              duration=fx.hours,
+                              num_processes=1,
+                              per_satellite=True,
+                              return_tree=False,
+                              prefilter=False)
+
+    yield 'compute_all_passes.no_prefilter', run, npairs
+
+
+def getpasses(fx, params):
+    """Loading passes with and without filters, from the database and from
+    the exported columns."""
+    gs = sorted(fx.stations)[0]
+    norad = sorted(fx.satellites)[0]
+    start = fx.start + timedelta(hours=fx.hours / 4)
+    end = start + timedelta(hours=fx.hours / 4)
+    npasses = len(db.getpasses(fx.passes_db, as_array=True))
+
+    for as_array in (False, True):
+        suffix = '_array' if as_array else ''
+        yield ('getpasses.all' + suffix,
+               lambda a=as_array: db.getpasses(fx.passes_db, as_array=a),
+               npasses)
+        yield ('getpasses.gs' + suffix,
+               lambda a=as_array: db.getpasses(fx.passes_db, gs=gs,
+                                               as_array=a),
+               npasses)
+        yield ('getpasses.sat' + suffix,
+               lambda a=as_array: db.getpasses(fx.passes_db, sat=norad,
+                                               as_array=a),
+               npasses)
+        yield ('getpasses.window' + suffix,
+               lambda a=as_array: db.getpasses(fx.passes_db, start=start,
+                                               end=end, as_array=a),
+               npasses)
+
+    # the same passes split into one table per day
+    partitioned = os.path.join(fx.directory, 'passes-day.sqlite')
+    source = sqlite3.connect(fx.passes_db)
+    target = sqlite3.connect(partitioned)
+    source.backup(target)
+    target.close()
+    source.close()
+    db.migrate_passes_db(partitioned, partition='day')
+    yield ('getpasses.window_partitioned',
+           lambda: db.getpasses(partitioned, start=start, end=end), npasses)
+
+    directory = os.path.join(fx.directory, 'passes-npy')
+    db.export_passes(directory, fx.passes_db)
+    yield ('load_passes.all',
+           lambda: db.load_passes(directory), npasses)
+    yield ('load_passes.gs',
+           lambda: db.load_passes(directory, gs=gs), npasses)
+    yield ('load_passes.sat',
+           lambda: db.load_passes(directory, sat=norad), npasses)
+    yield ('load_passes.window',
+           lambda: db.load_passes(directory, start=start, end=end), npasses)
+
+
+def _scheduler_args(cls, fx):
+    """Extra arguments for the schedulers which need them."""
+    if issubclass(cls, schedulers.OwnerPreferenceScheduler):
+        # every other station prefers a few satellites
+        norads = sorted(fx.satellites)
+        return {'priority': {gs: norads[i % 3::7]
+                             for i, gs in enumerate(sorted(fx.stations))
+                             if i % 2 == 0}}
+    if cls is schedulers.SchedulerPipeline:
+        return {'stages': (schedulers.MaxWeightStage(),)}
+    return {}
+
+
+# the reference EndStartSearchScheduler is quadratic in the number of passes
+SEARCH_LIMIT = 2000
+
+
+def scheduler_classes():
+    """Every Scheduler subclass, by name."""
+    return sorted((cls for cls in vars(schedulers).values()
+                   if isinstance(cls, type)
+                   and issubclass(cls, schedulers.Scheduler)
+                   and cls is not schedulers.Scheduler),
+                  key=lambda cls: cls.__name__)
+
+
+def scheduling(fx, params):
+    """Each scheduler on all the passes, with new YesClients every time."""
+    passes = db.getpasses(fx.passes_db, as_array=True)
+
+    for cls in scheduler_classes():
+        cls_passes = passes
+        if cls is schedulers.EndStartSearchScheduler:
+            cls_passes = passes[:SEARCH_LIMIT]
+        kwargs = _scheduler_args(cls, fx)
+
+        def run(cls=cls, passes=cls_passes, kwargs=kwargs):
+            random.seed(params['seed'])
+            clients = {name: client.YesClient(gs)
+                       for name, gs in fx.stations.items()}
+            cls(clients, fx.satellites, passes=passes, **kwargs)
+
+        yield 'schedulers.' + cls.__name__, run, len(cls_passes)
+
+
+def client_queries(fx, params):
+    """Aggregate queries of the clients' calendars after scheduling all
+    passes with FirstScheduler."""
+    passes = db.getpasses(fx.passes_db, as_array=True)
+    clients = {name: client.YesClient(gs) for name, gs in fx.stations.items()}
+    schedulers.FirstScheduler(clients, fx.satellites, passes=passes)
+    clients = list(clients.values())
+
+    rng = random.Random(params['seed'])
+    span = fx.hours * 3600
+    windows = []
+    for _ in range(params['queries']):
+        start = fx.start + timedelta(seconds=rng.uniform(0, span))
+        end = start + timedelta(seconds=rng.uniform(0, span / 4))
+        windows.append((start, end))
+    nqueries = len(windows) * len(clients)
+
+    def queries(method):
+        def run():
+            for c in clients:
+                f = getattr(c, method)
+                for start, end in windows:
+                    f(start, end)
+        return run
+
+    yield 'clients.busy_time', queries('busy_time'), nqueries
+    yield 'clients.calendar_value', queries('calendar_value'), nqueries
+
+    def search():
+        for c in clients:
+            for start, end in windows:
+                c.calendar.search(start, end)
+                c.calendar[start]
+    yield 'clients.search', search, nqueries
+
+    def whole(method):
+        return lambda: [getattr(c, method)() for c in clients]
+
+    yield 'clients.busy_time_total', whole('busy_time'), len(clients)
+    yield 'clients.daily_busy_time', whole('daily_busy_time'), len(clients)
+    yield 'clients.hourly_busy_time', whole('hourly_busy_time'), len(clients)
+
+
+def client_requests(fx, params):
+    """Requests for all the passes straight to new YesClients, in start
+    order, reversed and shuffled, and shuffled with a busy time and value
+    query after each.  Out of order requests insert into the middle of the
+    calendars."""
+    passes = db.getpasses(fx.passes_db, as_array=True)
+    requests = [(pd.data.gs,
+                 schedulers.pass2request(pd, fx.satellites, job_id),
+                 pd.begin, pd.end)
+                for job_id, pd in enumerate(passes, 1)]
+    orders = (('in_order', requests),
+              ('reversed', requests[::-1]),
+              ('shuffled',
+               random.Random(params['seed']).sample(requests, len(requests))))
+
+    for name, ordered in orders:
+        def run(ordered=ordered):
+            clients = {name: client.YesClient(gs)
+                       for name, gs in fx.stations.items()}
+            for gs, r, start, end in ordered:
+                clients[gs].request_times(r, start, end)
+
+        yield 'clients.request_' + name, run, len(ordered)
+
+    def interleaved():
+        clients = {name: client.YesClient(gs)
+                   for name, gs in fx.stations.items()}
+        for gs, r, start, end in orders[-1][1]:
+            c = clients[gs]
+            c.request_times(r, start, end)
+            c.busy_time(start, end)
+            c.calendar_value(start, end)
+
+    yield 'clients.request_query_shuffled', interleaved, len(requests)
+
+
+GROUPS = (engines, compute_all_passes, getpasses, scheduling, client_queries,
+          client_requests)
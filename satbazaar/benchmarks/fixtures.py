@@ -0,0 +1,143 @@
+"""Synthetic stations, satellites and pass database for the benchmarks.
+
+Everything is generated from a seed, so two runs with the same parameters
+work on the same data.  The mix is roughly that of the SatNOGS network:
+stations mostly at northern mid-latitudes, satellites mostly LEO cubesats
+in sun-synchronous or ISS orbits, plus a few GEO and Molniya orbits.
+"""
+import contextlib
+import io
+import os
+import random
+from datetime import datetime
+
+import ephem
+
+from satbazaar import db
+
+
+def checksum(line):
+    """TLE checksum digit of the first 68 characters of a line."""
+    return str(sum(int(c) if c.isdigit() else c == '-'
+                   for c in line[:68]) % 10)
+
+
+def make_tle(norad, epoch, inc, raan, ecc, argp, ma, mm):
+    """3 element list of a TLE with valid checksums.
+
+    epoch -- datetime
+    inc, raan, argp, ma -- degrees
+    ecc -- eccentricity
+    mm -- mean motion in revolutions per day
+    """
+    day = (epoch - datetime(epoch.year, 1, 1)).total_seconds() / 86400 + 1
+    line1 = ('1 %05dU 18001A   %02d%012.8f  .00000100  00000-0  10000-4 0  999'
+             % (norad, epoch.year % 100, day))
+    line2 = ('2 %05d %8.4f %8.4f %07d %8.4f %8.4f %11.8f%5d'
+             % (norad, inc, raan, int(ecc * 1e7), argp, ma, mm, 1))
+    line1 = line1[:68].ljust(68)
+    line2 = line2[:68].ljust(68)
+    return ['SAT %05d' % norad, line1 + checksum(line1), line2 + checksum(line2)]
+
+
+def make_stations(n, seed=1):
+    """Dict of n station dicts keyed by name, in the format of
+    db.load_stations()."""
+    rng = random.Random(seed)
+    stations = {}
+    for i in range(n):
+        name = 'GS%03d' % i
+        lat = max(-75.0, min(75.0, rng.gauss(35, 25)))
+        lon = rng.uniform(-180, 180)
+        alt = rng.uniform(0, 1500)
+        stations[name] = {
+            'id': i,
+            'name': name,
+            'lat': round(lat, 4),
+            'lon': round(lon, 4),
+            'lng': round(lon, 4),
+            'alt': round(alt),
+            'altitude': round(alt),
+            'min_horizon': rng.choice((0, 5, 10, 15, 20)),
+            'status': 'Online',
+        }
+    return stations
+
+
+def _orbit(k, rng):
+    """(inc, ecc, argp, mm) of the k-th satellite."""
+    kind = k % 20
+    if kind == 0:
+        # geostationary
+        return rng.uniform(0, 0.1), rng.uniform(0, 0.0005), 0, 1.0027
+    if kind == 1:
+        # Molniya
+        return 63.4, 0.7, 270, 2.006
+    if kind in (2, 3):
+        # assorted LEO
+        return (rng.uniform(20, 90), rng.uniform(0.0005, 0.02),
+                rng.uniform(0, 360), rng.uniform(13.5, 15))
+    if kind < 9:
+        # deployed from the ISS
+        return (51.6, rng.uniform(0.0002, 0.002),
+                rng.uniform(0, 360), rng.uniform(15.5, 15.7))
+    # sun-synchronous
+    return (rng.uniform(97, 98.5), rng.uniform(0.0005, 0.005),
+            rng.uniform(0, 360), rng.uniform(14.8, 15.3))
+
+
+def make_satellites(n, epoch, seed=1):
+    """Dict of n satellite dicts with TLEs at epoch, keyed by NORAD number,
+    in the format of db.load_satellites()."""
+    rng = random.Random(seed)
+    satellites = {}
+    for k in range(n):
+        norad = 90000 + k
+        inc, ecc, argp, mm = _orbit(k, rng)
+        tle = make_tle(norad, epoch, inc, rng.uniform(0, 360), ecc, argp,
+                       rng.uniform(0, 360), mm)
+        satellites[norad] = {
+            'norad_cat_id': norad,
+            'name': tle[0],
+            'status': 'alive',
+            'tle': tle,
+        }
+    return satellites
+
+
+class Fixture:
+    """Stations, satellites and their passes in a pass database in
+    `directory`.
+
+    start_time -- ephem.date string of the start of the passes
+    hours -- length of the pass window
+    """
+    def __init__(self, directory, n_stations=10, n_satellites=20, hours=24,
+                 start_time='2018/8/16 00:00:00', seed=1):
+        self.directory = directory
+        self.start_time = start_time
+        self.hours = hours
+        self.seed = seed
+        self.start = ephem.date(start_time).datetime()
+        self.stations = make_stations(n_stations, seed)
+        self.satellites = make_satellites(n_satellites, self.start, seed)
+        self.passes_db = os.path.join(directory, 'passes.sqlite')
+        with contextlib.redirect_stdout(io.StringIO()):
+            db.compute_all_passes(self.stations.values(),
+                                  self.satellites.values(),
+                                  start_time,
+                                  passes_db=self.passes_db,
+                                  duration=hours,
+                                  num_processes=1,
+                                  per_satellite=True,
+                                  return_tree=False)
+
+    def params(self):
+        """Parameters of the fixture, for the results file."""
+        return {
+            'stations': len(self.stations),
+            'satellites': len(self.satellites),
+            'hours': self.hours,
+            'start_time': self.start_time,
+            'seed': self.seed,
+        }
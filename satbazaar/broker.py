@@ -0,0 +1,300 @@
+"""`broker` -- Asynchronous broker harness
+=========================================
+
+Runs the requests of a Scheduler against Clients over an asynchronous
+transport to measure the broker side: many requests in flight, network
+latency and jitter, timeouts, and the resulting throughput, tail latency and
+accept rate.
+
+Each station serves its requests one at a time from a queue, like a real
+station would.  Two transports are available:
+
+    QueueTransport -- in-memory asyncio queues with simulated latency
+    SocketTransport -- JSON lines over loopback TCP, one server per station,
+                       requests are serialized with Request.to_dict()
+
+Example:
+
+    broker = Broker(clients, QueueTransport(latency=0.02, jitter=0.01))
+    requests = scheduler_requests(FirstScheduler(clients, satellites), passes)
+    report = broker.run(requests, max_in_flight=500)
+    print(format_report(report))
+"""
+import asyncio
+from collections.abc import Mapping
+from datetime import datetime
+import json
+import random
+import time
+
+from satbazaar.schedulers import pass2request
+
+
+def scheduler_requests(scheduler, passes):
+    """List of (gs, request) in the order the scheduler makes them, without
+    sending them to the clients."""
+    requests = []
+
+    def capture(pd, r=None):
+        if r is None:
+            r = pass2request(pd, scheduler.satellites, next(scheduler.job_ids))
+        requests.append((pd.data.gs, r))
+
+    scheduler.do_request = capture
+    try:
+        scheduler(passes)
+    finally:
+        del scheduler.do_request
+    return requests
+
+
+def jsonable(obj):
+    """Nested dicts and lists of a Request, Offer or Job for json.dumps()."""
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if isinstance(obj, Mapping):
+        return {k: jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [jsonable(v) for v in obj]
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return obj
+
+
+class QueueTransport:
+    """In-memory transport.  Each direction of a request is delayed by
+    latency plus a uniform random jitter (seconds), and the station takes
+    service_time to handle a request.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, service_time=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.service_time = service_time
+        self.random = random.Random(seed)
+        self._queues = {}
+        self._workers = []
+
+    def delay(self):
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    async def start(self, clients):
+        for name, client in clients.items():
+            queue = self._queues[name] = asyncio.Queue()
+            self._workers.append(asyncio.ensure_future(
+                self._station(client, queue)))
+
+    async def _station(self, client, queue):
+        while True:
+            r, future = await queue.get()
+            if self.service_time:
+                await asyncio.sleep(self.service_time)
+            offer = client.request(r)
+            if not future.done():
+                future.set_result(offer)
+
+    async def send(self, gs, r):
+        await asyncio.sleep(self.delay())
+        future = asyncio.get_event_loop().create_future()
+        await self._queues[gs].put((r, future))
+        offer = await future
+        await asyncio.sleep(self.delay())
+        return offer
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queues = {}
+
+
+class SocketTransport(QueueTransport):
+    """Loopback TCP transport.  Every station listens on its own port and
+    answers JSON requests, one per line, with JSON offers.  Requests on a
+    connection are matched to offers by job ID, so many can be in flight.
+    Latency and jitter are added on top of the real socket round-trip.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, service_time=0.0, seed=None,
+                 host='127.0.0.1'):
+        super().__init__(latency, jitter, service_time, seed)
+        self.host = host
+        self._servers = []
+        self._connections = {}
+
+    async def start(self, clients):
+        for name, client in clients.items():
+            server = await asyncio.start_server(
+                lambda reader, writer, client=client:
+                    self._serve(client, reader, writer),
+                self.host, 0)
+            self._servers.append(server)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection(self.host, port)
+            pending = {}
+            self._connections[name] = (writer, pending)
+            self._workers.append(asyncio.ensure_future(
+                self._receive(reader, pending)))
+
+    async def _serve(self, client, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            r = json.loads(line)
+            if self.service_time:
+                await asyncio.sleep(self.service_time)
+            offer = jsonable(client.request(r))
+            writer.write(json.dumps({'id': r['job']['id'],
+                                     'offer': offer}).encode() + b'\n')
+            await writer.drain()
+        writer.close()
+
+    async def _receive(self, reader, pending):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            future = pending.pop(message['id'], None)
+            if future is not None and not future.done():
+                future.set_result(message['offer'])
+
+    async def send(self, gs, r):
+        writer, pending = self._connections[gs]
+        await asyncio.sleep(self.delay())
+        future = asyncio.get_event_loop().create_future()
+        pending[r['job']['id']] = future
+        writer.write(json.dumps(jsonable(r)).encode() + b'\n')
+        await writer.drain()
+        try:
+            offer = await future
+        finally:
+            pending.pop(r['job']['id'], None)
+        await asyncio.sleep(self.delay())
+        return offer
+
+    async def stop(self):
+        for writer, pending in self._connections.values():
+            writer.close()
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+        self._connections = {}
+        await super().stop()
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of sorted values, nearest rank."""
+    if not values:
+        return float('nan')
+    k = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[k]
+
+
+class Broker:
+    """Sends requests to clients over a transport with a bounded number of
+    requests in flight, and reports how it went.
+
+    timeout is the number of seconds to wait for an offer before counting
+    the request as timed out.  The station may still act on it.
+    """
+    def __init__(self, clients, transport=None, timeout=10.0):
+        self.clients = clients
+        self.transport = transport if transport is not None else QueueTransport()
+        self.timeout = timeout
+
+    async def _send(self, gs, r, semaphore, results):
+        async with semaphore:
+            t = time.perf_counter()
+            try:
+                offer = await asyncio.wait_for(
+                    self.transport.send(gs, r), self.timeout)
+                status = offer['status']
+            except asyncio.TimeoutError:
+                status = 'timeout'
+            results.append((status, time.perf_counter() - t))
+
+    async def run_async(self, requests, max_in_flight=100):
+        """Send [(gs, request)] and return the report dict."""
+        semaphore = asyncio.Semaphore(max_in_flight)
+        results = []
+        await self.transport.start(self.clients)
+        t = time.perf_counter()
+        try:
+            await asyncio.gather(*(self._send(gs, r, semaphore, results)
+                                   for gs, r in requests))
+        finally:
+            elapsed = time.perf_counter() - t
+            await self.transport.stop()
+        return self.report(results, elapsed, max_in_flight)
+
+    def run(self, requests, max_in_flight=100):
+        """Blocking version of run_async()."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                self.run_async(requests, max_in_flight))
+        finally:
+            loop.close()
+
+    def report(self, results, elapsed, max_in_flight):
+        """Throughput, latency percentiles (ms) of the answered requests and
+        outcome counts."""
+        latencies = sorted(latency for status, latency in results
+                           if status != 'timeout')
+        counts = {'accept': 0, 'reject': 0, 'timeout': 0}
+        for status, latency in results:
+            counts[status] = counts.get(status, 0) + 1
+        n = len(results)
+        return {
+            'transport': type(self.transport).__name__,
+            'max_in_flight': max_in_flight,
+            'requests': n,
+            'elapsed': elapsed,
+            'requests_per_sec': n / elapsed if elapsed > 0 else float('nan'),
+            'latency_p50_ms': 1000 * percentile(latencies, 50),
+            'latency_p90_ms': 1000 * percentile(latencies, 90),
+            'latency_p99_ms': 1000 * percentile(latencies, 99),
+            'latency_max_ms': 1000 * percentile(latencies, 100),
+            'accepted': counts['accept'],
+            'rejected': counts['reject'],
+            'timeouts': counts['timeout'],
+            'accept_rate': counts['accept'] / n if n else float('nan'),
+        }
+
+
+def format_report(report):
+    """Human readable lines of a Broker report."""
+    return '\n'.join((
+        '{transport}, {max_in_flight} in flight'.format(**report),
+        '%10i requests in %.2f s, %.0f req/s' % (
+            report['requests'], report['elapsed'], report['requests_per_sec']),
+        '    latency ms  p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % (
+            report['latency_p50_ms'], report['latency_p90_ms'],
+            report['latency_p99_ms'], report['latency_max_ms']),
+        '    %i accepted, %i rejected, %i timed out, accept rate %.3f' % (
+            report['accepted'], report['rejected'], report['timeouts'],
+            report['accept_rate']),
+    ))
+
+
+# run a scheduler through the broker on the configured pass database
+if __name__ == '__main__':
+    import sys
+
+    from satbazaar import db, client, schedulers
+
+    passes_db = sys.argv[1] if len(sys.argv) > 1 else None
+    stations = db.load_stations()
+    satellites = db.load_satellites()
+    passes = db.getpasses(passes_db, as_array=True)
+
+    for transport in (QueueTransport(latency=0.005, jitter=0.005, seed=1),
+                      SocketTransport(seed=1)):
+        clients = {name: client.YesClient(gs)
+                   for name, gs in stations.items()}
+        scheduler = schedulers.FirstScheduler(clients, satellites)
+        requests = scheduler_requests(scheduler, passes)
+        broker = Broker(clients, transport)
+        print(format_report(broker.run(requests, max_in_flight=200)))
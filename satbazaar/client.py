@@ -1,20 +1,461 @@
 
 
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
-from intervaltree import Interval, IntervalTree
+from intervaltree import Interval
 from iso8601 import parse_date
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_USEC = timedelta(microseconds=1)
 
 
+def as_utc(t):
+    """Return a timezone aware datetime from a datetime (naive is taken as
+    UTC), an ISO 8601 string or epoch seconds."""
+    if isinstance(t, datetime):
+        if t.tzinfo is None:
+            return t.replace(tzinfo=timezone.utc)
+        return t
+    if isinstance(t, str):
+        return parse_date(t)
+    return datetime.fromtimestamp(t, timezone.utc)
+
+
+def usec(t):
+    """Integer epoch microseconds of a datetime (naive is taken as UTC), an
+    ISO 8601 string or a number of epoch seconds."""
+    if isinstance(t, (int, float)):
+        return round(t * 1000000)
+    return (as_utc(t) - EPOCH) // ONE_USEC
+
+
+def _bounty_value(data):
+    """{currency: amount} of a request's bounty, empty without one."""
+    value = defaultdict(float)
+    try:
+        bounties = data['bounty']
+    except (KeyError, TypeError):
+        return value
+    for unit in bounties:
+        value[unit['currency']] += unit['amount']
+    return value
+
+
+class _PrefixSums:
+    """Sorted keys, each with a {currency: amount}, answering how many keys
+    fall below a bound, their sum and their total amounts.
+
+    Keys are kept in blocks of LOAD to 2 * LOAD, with Fenwick trees (binary
+    indexed trees) of the block totals, so the whole blocks below a bound add
+    up in O(log n) and only the block holding the bound is summed key by
+    key.  An insert goes into one block and updates O(log n) tree nodes,
+    unlike prefix sums by position which change after every insert.  A block
+    which grows too large is split in two and the trees are rebuilt from the
+    block totals by the next query.
+    """
+    LOAD = 64
+
+    def __init__(self):
+        self._keys = []  # blocks of sorted keys
+        self._amounts = []  # and their {currency: [amount of each key]}
+        self._lasts = []  # last key of each block
+        self._currencies = set()
+        # totals of each block
+        self._block_sums = []
+        self._block_values = []
+        # (counts, sums, {currency: amounts}) trees indexed from 1, None
+        # after a split
+        self._trees = None
+
+    def insert(self, key, value):
+        if not self._keys:
+            self._keys.append([])
+            self._amounts.append({})
+            self._lasts.append(key)
+            self._block_sums.append(0)
+            self._block_values.append(defaultdict(float))
+            self._trees = None
+        j = min(bisect_left(self._lasts, key), len(self._keys) - 1)
+        keys = self._keys[j]
+        k = bisect_right(keys, key)
+        keys.insert(k, key)
+        amounts = self._amounts[j]
+        for currency in value:
+            if currency not in amounts:
+                amounts[currency] = [0.0] * (len(keys) - 1)
+        for currency, block in amounts.items():
+            block.insert(k, value.get(currency, 0.0))
+        self._lasts[j] = keys[-1]
+        self._block_sums[j] += key
+        block_value = self._block_values[j]
+        for currency, amount in value.items():
+            block_value[currency] += amount
+
+        if not self._currencies.issuperset(value):
+            self._currencies.update(value)
+            self._trees = None
+        if len(keys) > 2 * self.LOAD:
+            self._split(j)
+        elif self._trees is not None:
+            counts, sums, values = self._trees
+            i = j + 1
+            n = len(counts)
+            while i < n:
+                counts[i] += 1
+                sums[i] += key
+                for currency, amount in value.items():
+                    values[currency][i] += amount
+                i += i & -i
+
+    def _split(self, j):
+        """Split block j in halves."""
+        keys = self._keys[j]
+        amounts = self._amounts[j]
+        half = len(keys) // 2
+        head = {currency: block[:half] for currency, block in amounts.items()}
+        tail = {currency: block[half:] for currency, block in amounts.items()}
+        self._keys[j:j + 1] = [keys[:half], keys[half:]]
+        self._amounts[j:j + 1] = [head, tail]
+        self._lasts[j:j + 1] = [keys[half - 1], keys[-1]]
+        self._block_sums[j:j + 1] = [sum(keys[:half]), sum(keys[half:])]
+        self._block_values[j:j + 1] = [
+            defaultdict(float, {currency: sum(block)
+                                for currency, block in part.items()})
+            for part in (head, tail)]
+        self._trees = None
+
+    def _fenwick(self):
+        """The trees, built from the block totals in O(number of blocks) if
+        needed."""
+        if self._trees is None:
+            counts = [0] + [len(keys) for keys in self._keys]
+            sums = [0] + self._block_sums
+            values = {currency: [0.0] + [block.get(currency, 0.0)
+                                         for block in self._block_values]
+                      for currency in self._currencies}
+            n = len(counts)
+            for tree in [counts, sums] + list(values.values()):
+                for i in range(1, n):
+                    parent = i + (i & -i)
+                    if parent < n:
+                        tree[parent] += tree[i]
+            self._trees = counts, sums, values
+        return self._trees
+
+    def _find(self, x, inclusive):
+        """Block holding the bound and the bisect function for it."""
+        find = bisect_right if inclusive else bisect_left
+        return find(self._lasts, x), find
+
+    def totals(self, x, inclusive=False):
+        """(number, sum) of the keys < x, or <= x if `inclusive`."""
+        counts, sums, values = self._fenwick()
+        j, find = self._find(x, inclusive)
+        count = 0
+        total = 0
+        i = j
+        while i > 0:
+            count += counts[i]
+            total += sums[i]
+            i -= i & -i
+        if j < len(self._keys):
+            keys = self._keys[j]
+            k = find(keys, x)
+            count += k
+            total += sum(keys[:k])
+        return count, total
+
+    def amounts(self, x, inclusive=False):
+        """{currency: total amount} of the keys < x, or <= x if
+        `inclusive`."""
+        counts, sums, values = self._fenwick()
+        j, find = self._find(x, inclusive)
+        amounts = defaultdict(float)
+        for currency, tree in values.items():
+            total = 0.0
+            i = j
+            while i > 0:
+                total += tree[i]
+                i -= i & -i
+            amounts[currency] = total
+        if j < len(self._keys):
+            k = find(self._keys[j], x)
+            for currency, block in self._amounts[j].items():
+                amounts[currency] += sum(block[:k])
+        return amounts
+
+
+class Calendar:
+    """Sorted collection of the Intervals of accepted requests.
+
+    Stands in for the IntervalTree previously used as BaseClient.calendar
+    and supports the same calls: add(), search(), calendar[t] and
+    calendar[a:b], begin(), end(), iteration (in start order) and len().
+
+    Begin and end times are kept as integer epoch microseconds in lists
+    sorted by begin, so inserts are binary searches.  While no two Intervals
+    overlap, as in the calendar of a YesClient, the ends are sorted too and
+    overlap checks are binary searches on them.  Once Intervals overlap, as
+    for an AllClient, a running maximum of the ends takes their place; it is
+    only brought up to date by overlap queries.
+
+    Sums of the begins and of the ends up to any time, kept in _PrefixSums
+    which take inserts anywhere, answer busy_seconds() and value() for any
+    range in O(log n), clipping jobs at the edges of the range.  They also
+    work for the overlapping calendar of an AllClient.
+    """
+    def __init__(self, intervals=None):
+        # in begin order
+        self._begins = []
+        self._ends = []
+        self._items = []
+        # sums of the begins and ends up to a time, with their values
+        self._begin_sums = _PrefixSums()
+        self._end_sums = _PrefixSums()
+        self._currencies = set()
+        # no two rows overlap, so _ends is sorted
+        self._disjoint = True
+        # latest end and its Interval
+        self._last_end = None
+        self._last_item = None
+        # running max of _ends once not _disjoint, valid up to its length
+        self._maxend = []
+        if intervals is not None:
+            for iv in intervals:
+                self.add(iv)
+
+    def _row(self, iv):
+        """(begin, end, value) of an Interval to insert."""
+        b = usec(iv.begin)
+        e = usec(iv.end)
+        if e <= b:
+            raise ValueError('Calendar does not store null Interval {}'.format(iv))
+        value = _bounty_value(iv.data)
+        self._currencies.update(value)
+        return b, e, value
+
+    def add(self, iv):
+        """Insert an Interval, its begin and end may be datetimes or epoch
+        seconds."""
+        b, e, value = self._row(iv)
+
+        i = bisect_right(self._begins, b)
+        if self._disjoint and ((i > 0 and self._ends[i - 1] > b)
+                               or (i < len(self._begins)
+                                   and self._begins[i] < e)):
+            self._disjoint = False
+        self._begins.insert(i, b)
+        self._ends.insert(i, e)
+        self._items.insert(i, iv)
+        del self._maxend[i:]
+
+        self._begin_sums.insert(b, value)
+        self._end_sums.insert(e, value)
+        self._extend_last(e, iv)
+
+    def _extend_last(self, e, iv):
+        """Keep the latest end up to date with an inserted Interval."""
+        if self._last_end is None or e > self._last_end:
+            self._last_end = e
+            self._last_item = iv
+
+    def update(self, intervals):
+        """Insert many Intervals, same as add() for each in turn.
+
+        Intervals starting after the current ones are appended, others are
+        merged in with one sort instead of a list insert each.
+        """
+        rows = [self._row(iv) + (iv,) for iv in intervals]
+        if not rows:
+            return
+        # stable, so equal begins stay in the order of add()
+        rows.sort(key=lambda row: row[0])
+        i = bisect_right(self._begins, rows[0][0])
+
+        if i == len(self._begins):
+            for b, e, value, iv in rows:
+                self._begins.append(b)
+                self._ends.append(e)
+                self._items.append(iv)
+        else:
+            old = list(zip(self._begins[i:], self._ends[i:],
+                           self._items[i:]))
+            merged = sorted(old + [(b, e, iv) for b, e, value, iv in rows],
+                            key=lambda row: row[0])
+            self._begins[i:] = [row[0] for row in merged]
+            self._ends[i:] = [row[1] for row in merged]
+            self._items[i:] = [row[2] for row in merged]
+        del self._maxend[i:]
+
+        if self._disjoint:
+            k = max(i - 1, 0)
+            self._disjoint = all(
+                e <= b for e, b in zip(self._ends[k:], self._begins[k + 1:]))
+        for b, e, value, iv in rows:
+            self._begin_sums.insert(b, value)
+            self._end_sums.insert(e, value)
+            self._extend_last(e, iv)
+
+    def addi(self, begin, end, data=None):
+        self.add(Interval(begin, end, data))
+
+    def _update(self):
+        n = len(self._maxend)
+        if n < len(self._ends):
+            last = self._maxend[-1] if n else -1
+            for e in self._ends[n:]:
+                if e > last:
+                    last = e
+                self._maxend.append(last)
+
+    def _first_ending_after(self, b):
+        """Row number in begin order before which all Intervals end by b."""
+        if self._disjoint:
+            return bisect_right(self._ends, b)
+        self._update()
+        return bisect_right(self._maxend, b)
+
+    def _overlap_index(self, begin, end=None, strict=False):
+        """Row numbers of the Intervals matching search()."""
+        b = usec(begin)
+        if end is None:
+            # point query: begin <= b < end
+            lo = self._first_ending_after(b)
+            hi = bisect_right(self._begins, b)
+            return [i for i in range(lo, hi) if self._ends[i] > b]
+
+        e = usec(end)
+        if b >= e:
+            return []
+        if strict:
+            lo = bisect_left(self._begins, b)
+            hi = bisect_left(self._begins, e)
+            return [i for i in range(lo, hi) if self._ends[i] <= e]
+
+        return self._overlap_usec(b, e)
+
+    def _overlap_usec(self, b, e):
+        """Row numbers of the Intervals overlapping [b, e) in
+        microseconds."""
+        lo = self._first_ending_after(b)
+        hi = bisect_left(self._begins, e)
+        return [i for i in range(lo, hi) if self._ends[i] > b]
+
+    def overlaps(self, begin, end=None):
+        """True if any Interval overlaps the point or range."""
+        return len(self._overlap_index(begin, end)) > 0
+
+    def search(self, begin, end=None, strict=False):
+        """Set of Intervals overlapping the point `begin` or the range
+        [begin, end), or only those enveloped by the range if `strict`.
+        `begin` may be an Interval, as IntervalTree.search().
+        """
+        if end is None and isinstance(begin, Interval):
+            begin, end = begin.begin, begin.end
+        return {self._items[i]
+                for i in self._overlap_index(begin, end, strict)}
+
+    def _range(self, begin=None, end=None):
+        """Range in microseconds, defaulting to the whole calendar."""
+        if isinstance(begin, Interval):
+            begin, end = begin.begin, begin.end
+        b = self._begins[0] if begin is None else usec(begin)
+        e = self._last_end if end is None else usec(end)
+        return b, e
+
+    def _busy_until(self, x):
+        """Total busy microseconds of all jobs before the instant x."""
+        k, begins = self._begin_sums.totals(x, inclusive=True)
+        m, ends = self._end_sums.totals(x, inclusive=True)
+        return (k * x - begins) - (m * x - ends)
+
+    def busy_seconds(self, begin=None, end=None):
+        """Seconds of jobs within [begin, end), clipped at the edges.
+        Overlapping jobs each count.  Defaults to the whole calendar."""
+        if not self._items:
+            return 0.0
+        b, e = self._range(begin, end)
+        if b >= e:
+            return 0.0
+        return (self._busy_until(e) - self._busy_until(b)) / 1e6
+
+    def busy_histogram(self, edges):
+        """Seconds of jobs between consecutive times in the sorted sequence
+        `edges`, a list one shorter than edges."""
+        if not self._items:
+            return [0.0] * max(len(edges) - 1, 0)
+        totals = [self._busy_until(usec(t)) for t in edges]
+        return [(e - b) / 1e6 for b, e in zip(totals, totals[1:])]
+
+    def value(self, begin=None, end=None):
+        """{currency: total bounty} of the jobs overlapping [begin, end).
+        Defaults to the whole calendar."""
+        value = defaultdict(float)
+        if not self._items:
+            return value
+        b, e = self._range(begin, end)
+        if b >= e:
+            return value
+        # jobs starting before the end, less those done by the beginning
+        started = self._begin_sums.amounts(e)
+        done = self._end_sums.amounts(b, inclusive=True)
+        for currency in sorted(self._currencies):
+            value[currency] = started[currency] - done[currency]
+        return value
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.search(key.start, key.stop)
+        return self.search(key)
+
+    def begin(self):
+        """Begin of the first Interval, 0 if empty like IntervalTree."""
+        if not self._items:
+            return 0
+        return self._items[0].begin
+
+    def end(self):
+        """End of the last Interval, 0 if empty like IntervalTree."""
+        if not self._items:
+            return 0
+        return self._last_item.end
+
+    def is_empty(self):
+        return not self._items
+
+    def items(self):
+        return set(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items))
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, iv):
+        return any(self._items[i] == iv
+                   for i in self._overlap_index(iv.begin, iv.end))
+
+    def __repr__(self):
+        return 'Calendar({})'.format(list(self._items))
+
 
 class BaseClient:
     """Base class to represent a SatNOGS client.  Subclasses implement the
     various ways a client accepts Requests or independently generates Offers.
 
-    calendar - an IntervalTree of accepted/scheduled requests
+    calendar - a Calendar of accepted/scheduled requests
+
+    request() takes the Request dict.  request_times() also takes its start
+    and end as datetimes or epoch seconds, which saves parsing the ISO 8601
+    strings of the job; by default it ignores them and calls request().
+    The times of a schedulers.Request are used directly.
+
+    request_batch() takes a list of Requests and returns the list of Offers,
+    the same as request() for each in turn.
     """
     def __init__(self, name, lat=None, lon=None, alt=None):
         if isinstance(name, dict):
@@ -29,7 +470,7 @@ class BaseClient:
             self.lon = float(lon)
             self.alt = float(alt)
 
-        self.calendar = IntervalTree()
+        self.calendar = Calendar()
 
     def __str__(self):
         """Return a better string than __repr__() for humans to read."""
@@ -46,18 +487,40 @@ class BaseClient:
         """
         raise NotImplemented('Cannot directly use the BaseClient class.')
 
+    def request_times(self, r, start, end):
+        """Same as request(), for callers which already have the job start
+        and end times.
+
+        Subclasses may override it to use them.
+        """
+        return self.request(r)
+
+    def request_batch(self, requests):
+        """Takes a list of Requests, returns the list of Offers.
+
+        Subclasses may override it to handle the whole batch at once.
+        """
+        return [self.request(r) for r in requests]
+
+    @staticmethod
+    def _job_times(job, start=None, end=None):
+        """Aware start and end datetimes of a job.  Uses the given times or
+        the datetimes of a schedulers.Job, only parsing the job's strings
+        otherwise."""
+        if start is None:
+            start = getattr(job, 'start', None)
+        if end is None:
+            end = getattr(job, 'end', None)
+        start = parse_date(job['start']) if start is None else as_utc(start)
+        end = parse_date(job['end']) if end is None else as_utc(end)
+        return start, end
+
     def calendar_value(self, start=None, end=None):
         """Returns a dict of the total potential bounties offered for the
         scheduled jobs during the requested range.  Default to the entire
         range.
         """
-        calendar_range = self._choprange(start, end)
-        value = defaultdict(float)
-        for i in calendar_range:
-            bounties = i.data['bounty']
-            for unit in bounties:
-                value[unit['currency']] += unit['amount']
-        return value
+        return self.calendar.value(start, end)
 
     @property
     def calendar_begin(self):
@@ -69,65 +532,40 @@ class BaseClient:
         """Returns end time of last job in calendar."""
         return self.calendar.end()
 
-    def _choprange(self, start=None, end=None):
-        """Helper to return a sub IntervalTree chopped to the given range.
-        """
-        # IntervalTree doesn't behave well when searching zero-length tress
-        if len(self.calendar) == 0:
-            return self.calendar
-        b = self.calendar.begin()
-        e = self.calendar.end()
-        if start is not None:
-            if isinstance(start, Interval):
-                b = start.begin
-                e = start.end
-            else:
-                b = start
-
-            if end is not None:
-                e = end
-        # get trimmed intervals in requested range
-        # .search() returns a set()
-        iv = IntervalTree(self.calendar.search(b, e))
-        # the following should work, but chop() is having issues with chopping
-        # too much (all the way to zero!)
-        # iv.chop(b, e)  # <--- whuzzup??
-        # cheat and expand the chop interval by a microsecond on each side
-        # iv.chop(b - timedelta(seconds=1), e + timedelta(seconds=1))
-        # ^^^ still doesn't work.
-        # TODO: fix iv.chop()
-        # Just return the searched interval and not trim the ends
-        return iv
-
     def busy_time(self, start=None, end=None):
         """Returns the total time in seconds of scheduled jobs during the
-        given range.  Defaults to the entire range.
+        given range, counting only the part of jobs inside the range.
+        Defaults to the entire range.
         """
-        total = timedelta(0)
-        iv = self._choprange(start, end)
-        for r in iv:
-            s = parse_date(r.data['job']['start'])
-            e = parse_date(r.data['job']['end'])
-            diff = e - s
-            total += diff
-        return total.total_seconds()
+        return self.calendar.busy_seconds(start, end)
+
+    def _busy_time_bins(self, start, end, step, floor):
+        """Busy seconds per `step` from floor(start) through the bin
+        containing end."""
+        if len(self.calendar) == 0:
+            return []
+        start = floor(as_utc(self.calendar_begin if start is None else start))
+        end = as_utc(self.calendar_end if end is None else end)
+        edges = [start]
+        while edges[-1] <= end:  # we want the thru the end of this bin
+            edges.append(edges[-1] + step)
+        return self.calendar.busy_histogram(edges)
 
     def daily_busy_time(self, start=None, end=None):
         """Returns the total time in seconds of scheduled jobs per day
         during the given range. Defaults to the entire range.
         """
-        start = self.calendar_begin()
-        end = self.calendar_end()
-        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = end.replace(hour=0, minute=0, second=0, microsecond=0)
-        oneday = timedelta(days=1)
-        busy_time_days = []
-        while start <= end:  # we want the thru the end of this day
-            dayend = start + oneday
-            sec = self.busy_time(start, dayend)
-            busy_time_days.append(sec)
-            start = dayend
-        return busy_time_days
+        return self._busy_time_bins(
+            start, end, timedelta(days=1),
+            lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0))
+
+    def hourly_busy_time(self, start=None, end=None):
+        """Returns the total time in seconds of scheduled jobs per hour
+        during the given range. Defaults to the entire range.
+        """
+        return self._busy_time_bins(
+            start, end, timedelta(hours=1),
+            lambda t: t.replace(minute=0, second=0, microsecond=0))
 
 
 class AllClient(BaseClient):
@@ -139,11 +577,13 @@ class AllClient(BaseClient):
     arbitrary number of simultaneous receivers.
     """
     def request(self, r):
+        return self.request_times(r, None, None)
+
+    def request_times(self, r, start, end):
         job = r['job']
         bounty = r['bounty']
 
-        start = parse_date(job['start'])
-        end = parse_date(job['end'])
+        start, end = self._job_times(job, start, end)
 
         ri = Interval(start, end, r)
 
@@ -153,6 +593,19 @@ class AllClient(BaseClient):
                  'fee': bounty}
         return offer
 
+    def request_batch(self, requests):
+        intervals = []
+        offers = []
+        for r in requests:
+            job = r['job']
+            start, end = self._job_times(job)
+            intervals.append(Interval(start, end, r))
+            offers.append({'status': 'accept',
+                           'job': job,
+                           'fee': r['bounty']})
+        self.calendar.update(intervals)
+        return offers
+
 
 class YesClient(BaseClient):
     """Represents a SatNOGS client which implements the SatNOGS-Broker
@@ -163,27 +616,62 @@ class YesClient(BaseClient):
     data.
     """
     def request(self, r):
+        return self.request_times(r, None, None)
+
+    def request_times(self, r, start, end):
         job = r['job']
         bounty = r['bounty']
 
-        start = parse_date(job['start'])
-        end = parse_date(job['end'])
+        start, end = self._job_times(job, start, end)
 
-        ri = Interval(start, end, r)
-
-        overlaps = self.calendar.search(ri)
-
-        if len(overlaps) == 0:
-            self.calendar.add(ri)
+        if not self.calendar.overlaps(start, end):
+            self.calendar.add(Interval(start, end, r))
             offer = {'status': 'accept',
                      'job': job,
                      'fee': bounty}
         else:
+            overlaps = self.calendar.search(start, end)
             offer = {'status': 'reject',
                      'reason': 'time overlap',
                      'extra': [o.data for o in overlaps]}
         return offer
 
+    def request_batch(self, requests):
+        """Offers for a list of Requests.  If they are sorted by start time
+        overlaps within the batch are resolved in one sweep and the accepted
+        jobs added together, otherwise they are requested one by one.
+        """
+        jobs = [r['job'] for r in requests]
+        times = [self._job_times(job) for job in jobs]
+        if any(a[0] > b[0] for a, b in zip(times, times[1:])):
+            return [self.request_times(r, start, end)
+                    for r, (start, end) in zip(requests, times)]
+
+        calendar = self.calendar
+        accepted = []
+        offers = []
+        for r, job, (start, end) in zip(requests, jobs, times):
+            # the calendar doesn't change during the batch
+            rows = calendar._overlap_usec(usec(start), usec(end))
+            # accepted jobs don't overlap and came in order of start, so only
+            # the latest ones can reach past this start
+            if rows or (accepted and accepted[-1].end > start):
+                overlaps = {calendar._items[i] for i in rows}
+                k = len(accepted)
+                while k > 0 and accepted[k - 1].end > start:
+                    k -= 1
+                    overlaps.add(accepted[k])
+                offers.append({'status': 'reject',
+                               'reason': 'time overlap',
+                               'extra': [o.data for o in overlaps]})
+            else:
+                accepted.append(Interval(start, end, r))
+                offers.append({'status': 'accept',
+                               'job': job,
+                               'fee': r['bounty']})
+        self.calendar.update(accepted)
+        return offers
+
 
 # testing the implementation
 if __name__ == '__main__':
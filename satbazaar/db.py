@@ -9,16 +9,20 @@ from a database.
 Ground Station information is stored in a JSON file.
 """
 import os
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, defaultdict
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from itertools import product, islice
+from itertools import chain, product, islice
 import json
 import multiprocessing
-from math import pi
+from math import pi, radians, sin, sqrt
 from io import StringIO
 import sqlite3
 import configparser
+import statistics
+import threading
+import time
 
 
 from lxml import html
@@ -61,6 +65,128 @@ STATION_KEYS = ('alt', 'lat', 'lon', 'min_horizon', 'name', 'status')
 
 
 
+class ConnectionManager:
+    """Thread-safe cache of open SQLite connections.
+
+    Each thread gets its own connection per database file and mode, which is
+    reused by later calls so repeated queries skip connection setup and
+    schema parsing and hit the prepared statement cache.  A connection is
+    reopened if the file was replaced since it was opened, and the cache is
+    dropped in a forked child process.
+
+    Read-only connections use mode=ro and query_only, writers switch the
+    database to WAL journaling so they don't block readers.  Writers call
+    release() when done, so the WAL is folded back into the database file.
+    """
+    READ_PRAGMAS = (
+        'PRAGMA query_only = ON;',
+        'PRAGMA mmap_size = 268435456;',  # 256 MiB
+        'PRAGMA cache_size = -65536;',  # 64 MiB
+    )
+    WRITE_PRAGMAS = (
+        'PRAGMA journal_mode = WAL;',
+        'PRAGMA synchronous = NORMAL;',
+        'PRAGMA cache_size = -65536;',
+    )
+
+    def __init__(self, cached_statements=256):
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'opens': 0, 'hits': 0, 'closes': 0})
+
+    def _count(self, path, event):
+        with self._lock:
+            self._stats[path][event] += 1
+
+    def _connections(self):
+        """This thread's dict of (path, readonly) -> (conn, file id)."""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # connections inherited over fork() must not be used
+            local.pid = os.getpid()
+            local.conns = {}
+        return local.conns
+
+    @staticmethod
+    def _file_id(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def get(self, dbfile, readonly=True):
+        """Return an open connection to `dbfile` for the calling thread.
+
+        Don't close it, use close() to drop cached connections.
+        """
+        path = os.path.abspath(dbfile)
+        conns = self._connections()
+        key = (path, readonly)
+        fid = self._file_id(path)
+
+        if key in conns:
+            conn, opened_fid = conns[key]
+            if opened_fid == fid:
+                self._count(path, 'hits')
+                return conn
+            # file was replaced since
+            conn.close()
+            del conns[key]
+            self._count(path, 'closes')
+
+        uri = 'file:' + path + ('?mode=ro' if readonly else '')
+        conn = sqlite3.connect(uri, uri=True,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               cached_statements=self.cached_statements)
+        for pragma in (self.READ_PRAGMAS if readonly else self.WRITE_PRAGMAS):
+            conn.execute(pragma)
+        conns[key] = (conn, self._file_id(path))
+        self._count(path, 'opens')
+        return conn
+
+    def close(self, dbfile=None):
+        """Close the calling thread's connections, to `dbfile` or all."""
+        conns = self._connections()
+        path = None if dbfile is None else os.path.abspath(dbfile)
+        for key in list(conns):
+            if path is None or key[0] == path:
+                conns.pop(key)[0].close()
+                self._count(key[0], 'closes')
+
+    def release(self, dbfile):
+        """Write the WAL back into `dbfile` and close the calling thread's
+        connections to it, so the file holds everything on its own and can
+        be copied or committed.  Called at the end of the functions which
+        write a passes database.
+        """
+        path = os.path.abspath(dbfile)
+        writer = self._connections().pop((path, False), None)
+        # readers first, an open read transaction would stop the checkpoint
+        self.close(dbfile)
+        if writer is not None:
+            conn = writer[0]
+            conn.commit()
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+            conn.close()
+            self._count(path, 'closes')
+
+    def stats(self, dbfile=None):
+        """Return counts of opened, reused and closed connections, for one
+        database or a dict of all of them by path.
+        """
+        with self._lock:
+            if dbfile is not None:
+                return dict(self._stats[os.path.abspath(dbfile)])
+            return {path: dict(v) for path, v in self._stats.items()}
+
+
+# shared by everything in this module
+connections = ConnectionManager()
+
+
+
 class TLE:
     """Class to access TLE attributes."""
     def __init__(self, tle, source=None):
@@ -124,6 +250,13 @@ class TLESource(Mapping):
     Configured sources are tried in order or raises a KeyError if the number is
     not found in any known source.
 
+    Found TLEs are kept in an LRU cache of at most `cache_size` entries
+    (None for unbounded) which expire after `ttl` seconds (None to keep
+    them).  Use get_many() to look up many satellites at once.
+
+    `sources` is a sequence of (name, class, argument) tuples, optionally
+    followed by a dict of keyword arguments for the class.
+
     Example:
     >>> d = TLESource()
 
@@ -133,25 +266,87 @@ class TLESource(Mapping):
     >>> repr(d[25544])  #doctest: +ELLIPSIS
     "TLE(source=CelesTrak, line0='ISS (ZARYA)', line1='1 25544U 98067A ..."
     """
-    def __init__(self, sources=None, fn=None):
-        self._data = {}
+    def __init__(self, sources=None, fn=None, cache_size=4096, ttl=60*60):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_size = cache_size
+        self.ttl = ttl
         if sources is None:
             sources = TLE_SOURCES
 
         self.data_source = {}
-        for name, method, arg in sources:
-            self.data_source[name] = method(name, arg)
+        for name, method, arg, *kwargs in sources:
+            kwargs = kwargs[0] if kwargs else {}
+            self.data_source[name] = method(name, arg, **kwargs)
+
+    def _cache_get(self, norad):
+        """Cached TLE or None if unknown or expired."""
+        with self._lock:
+            item = self._data.get(norad)
+            if item is None:
+                return None
+            expires, tle = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[norad]
+                return None
+            self._data.move_to_end(norad)
+            return tle
+
+    def _cache_put(self, norad, tle):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[norad] = (expires, tle)
+            self._data.move_to_end(norad)
+            if self.cache_size is not None:
+                while len(self._data) > self.cache_size:
+                    self._data.popitem(last=False)
+
+    def clear_cache(self):
+        with self._lock:
+            self._data.clear()
 
     def __getitem__(self, norad):
+        tle = self._cache_get(norad)
+        if tle is not None:
+            return tle
         for source, d in self.data_source.items():
-            if norad in d:
+            # not (norad in d), that would fetch twice from an API
+            try:
                 v = d[norad]
-                self._data[norad] = v
-                return v
+            except KeyError:
+                continue
+            self._cache_put(norad, v)
+            return v
         raise KeyError('Unknown satellite {}'.format(norad))
 
+    def get_many(self, norads):
+        """Return {norad: TLE} for the satellites found in any source.
+
+        Unknown satellites are left out.  Each source is asked once for all
+        the numbers not found in the sources before it.
+        """
+        found = {}
+        pending = []
+        for norad in OrderedDict.fromkeys(norads):
+            tle = self._cache_get(norad)
+            if tle is None:
+                pending.append(norad)
+            else:
+                found[norad] = tle
+
+        for d in self.data_source.values():
+            if not pending:
+                break
+            got = d.get_many(pending)
+            for norad, tle in got.items():
+                self._cache_put(norad, tle)
+            found.update(got)
+            pending = [norad for norad in pending if norad not in got]
+        return found
+
     def __iter__(self):
-        return iter(self._data)
+        with self._lock:
+            return iter(list(self._data))
 
     def __len__(self):
         return len(self._data)
@@ -159,25 +354,56 @@ class TLESource(Mapping):
 
 class APITLESource(TLESource):
     """Mapping which fetches TLEs from an API."""
-    def __init__(self, name, template):
+    def __init__(self, name, template, max_workers=8,
+                 session_factory=requests.session):
         """
         name: short string to identify the source
         template: URL template suitable for .format(norad)
+        max_workers: limit of concurrent requests to this source
+        session_factory: callable returning a requests.Session-like object,
+            one is made per thread
         """
         self.name = name
         self.template = template
-        self.client = requests.session()
+        self.max_workers = max_workers
+        self.session_factory = session_factory
+        self._local = threading.local()
+        self._limit = threading.BoundedSemaphore(max_workers)
+
+    @property
+    def client(self):
+        """Session of the calling thread, sessions aren't thread-safe."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.session_factory()
+        return session
 
     def __getitem__(self, norad):
-        r = self.client.get(self.template.format(norad))
+        with self._limit:
+            r = self.client.get(self.template.format(norad))
+        if r.status_code != 200 or not r.text.strip():
+            raise KeyError('{} not found'.format(norad))
         p = html.fromstring(r.text)
-        lines = p.xpath('//pre/text()')[0].split('\n')
+        pre = p.xpath('//pre/text()')
+        lines = pre[0].split('\n') if pre else []
         if len(lines) == 6:
             t = (lines[1].strip(), lines[2].strip(), lines[3].strip())
             return TLE(t, source=self.name)
         else:
             raise KeyError('{} not found'.format(norad))
 
+    def get_many(self, norads):
+        """Fetch {norad: TLE} with up to max_workers requests in flight."""
+        def fetch(norad):
+            try:
+                return norad, self[norad]
+            except KeyError:
+                return norad, None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return {norad: tle for norad, tle in pool.map(fetch, norads)
+                    if tle is not None}
+
 
 class FileTLESource(TLESource):
     """Mapping which reads TLEs from text files with 3 lines per satellite."""
@@ -193,15 +419,19 @@ class FileTLESource(TLESource):
     def __getitem__(self, norad):
         return self._data[norad]
 
+    def get_many(self, norads):
+        return {norad: self._data[norad] for norad in norads
+                if norad in self._data}
+
     def _get_fp(self, fname):
         """Return a file-like object to a local file or one served via http."""
-        if fname.startswith('http'):
+        if isinstance(fname, str) and fname.startswith('http'):
             r = requests.get(fname)
             return StringIO(r.text)
-        elif isinstance(fname, file):
-            return fname
         elif isinstance(fname, str):
             return open(fname)
+        elif hasattr(fname, 'read'):
+            return fname
         else:
             raise TypeError('Unhandled type {}'.format(type(fname)))
 
@@ -229,12 +459,9 @@ class SqliteTLESource(TLESource):
     def __init__(self, name, dbfile):
         self.name = name
         self.dbfile = dbfile
-        self.conn = sqlite3.connect(
-            'file:' + dbfile + '?mode=ro',
-            uri=True,
-            detect_types=sqlite3.PARSE_DECLTYPES)
-        self.conn.row_factory = sqlite3.Row
+        self.conn = connections.get(dbfile)
         self.cur = self.conn.cursor()
+        self.cur.row_factory = sqlite3.Row
 
     def __getitem__(self, norad):
         query = '''SELECT * FROM tle
@@ -247,6 +474,22 @@ class SqliteTLESource(TLESource):
         else:
             raise KeyError('{} not found'.format(norad))
 
+    def get_many(self, norads, chunk=500):
+        """Latest {norad: TLE} with one query per `chunk` numbers."""
+        cur = connections.get(self.dbfile).cursor()
+        cur.row_factory = sqlite3.Row
+        norads = list(norads)
+        found = {}
+        for i in range(0, len(norads), chunk):
+            batch = norads[i:i + chunk]
+            where = 'WHERE norad IN ({})'.format(','.join('?' * len(batch)))
+            cur.execute(LATEST_TLE_QUERY.format(where=where), batch)
+            for row in cur:
+                found[row['norad']] = TLE(
+                    (row['line0'], row['line1'], row['line2']),
+                    source=self.name)
+        return found
+
 
 # ordered by fallback priority
 TLE_SOURCES = (
@@ -346,33 +589,51 @@ def get_satellites():
     pass
 
 
-def load_satellites(satsfile=None, tledb=None):
+# SQLite returns the bare columns of the row holding max(downloaded), so one
+# pass over idx_tle_norad_downloaded picks the latest TLE of every satellite.
+# (Window functions would need SQLite >= 3.25.)
+LATEST_TLE_QUERY = """
+    SELECT norad, epoch, line0, line1, line2, max(downloaded) AS downloaded
+    FROM tle {where} GROUP BY norad"""
+
+
+def latest_tles(tledb=None, as_of=None):
+    """Return {norad: sqlite3.Row} of the most recently downloaded TLE of
+    every satellite in tledb.
+
+    With `as_of` (a datetime or ISO string) only TLEs downloaded at or before
+    that moment are considered, giving the TLE set known at that time.
+    """
+    tledb = tledb or config['DEFAULT']['tle_db']
+
+    cur = connections.get(tledb).cursor()
+    cur.row_factory = sqlite3.Row
+
+    if as_of is None:
+        cur.execute(LATEST_TLE_QUERY.format(where=''))
+    else:
+        where = 'WHERE julianday(downloaded) <= julianday(?)'
+        cur.execute(LATEST_TLE_QUERY.format(where=where), (as_of,))
+    return {row['norad']: row for row in cur}
+
+
+def load_satellites(satsfile=None, tledb=None, as_of=None):
     """Load satellites from satsfile (json) and pickup the latest TLE from
-    tledb.
+    tledb, or the latest downloaded at or before `as_of`.
 
     Only return satellites with complete information (a known TLE).
     """
 
     satsfile = satsfile or config['DEFAULT']['satellites_file']
-    tledb = tledb or config['DEFAULT']['tle_db']
 
     with open(satsfile) as f:
         sats = json.load(f)
     sats = {int(norad):sat for norad, sat in sats.items()}
 
-    conn = sqlite3.connect('file:' + tledb + '?mode=ro',
-                           uri=True,
-                           detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    def get_info(norad):
-        query = 'SELECT * FROM tle WHERE norad = ? ORDER BY downloaded DESC LIMIT 1'
-        cur.execute(query, (norad,))
-        return cur.fetchone()
+    tles = latest_tles(tledb, as_of)
 
     for norad, sat in sats.items():
-        row = get_info(norad)
+        row = tles.get(norad)
         if not row:
             continue
 
@@ -390,16 +651,210 @@ def load_observations(obsfile=None):
     return json.load(util.open_compressed(obsfile))
 
 
+# Layout of the passes database, stored in PRAGMA user_version
+#   0 -- timestamp text columns and the station name in every row
+#   1 -- integer epoch milliseconds, station ids into a stations table,
+#        (gs, start, end) and (start, end) indexes
+#   2 -- as 1, with the passes split by start time into one table per day
+#        or week, listed in the pass_partitions table
+PASSES_SCHEMA_VERSION = 1
+PARTITIONED_SCHEMA_VERSION = 2
+
+DAY_MS = 86400000
+# partition lengths in milliseconds, weeks start on Mondays
+PARTITION_SIZES = {'day': DAY_MS, 'week': 7 * DAY_MS}
+
+EPOCH = datetime(1970, 1, 1)
+
+# SQL expression converting a SQLite datetime string to epoch milliseconds
+SQL_EPOCH_MS = "CAST(round((julianday({}) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def to_epoch_ms(t):
+    """Integer milliseconds since the Unix epoch of a UTC datetime, which
+    may be naive (as returned from ephem) or timezone aware.
+    """
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc).replace(tzinfo=None)
+    us = (t - EPOCH) // timedelta(microseconds=1)
+    return (us + 500) // 1000
+
+
+def from_epoch_ms(ms):
+    """Naive UTC datetime from integer milliseconds since the Unix epoch."""
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def passes_db_version(conn):
+    """Schema version of an open passes database."""
+    return conn.execute('PRAGMA user_version;').fetchone()[0]
+
+
 def passrow2interval(p):
     data = PassTuple(**p)
     return Interval(data.start, data.end, data)
 
 
-def getpasses(passes_db=None, gs=None, sat=None, start=None, end=None):
+# PassTuple fields holding times
+TIME_COLUMNS = ('start', 'end', 'tca')
+
+
+def _passes_query(conn, gs=None, sat=None, start=None, end=None,
+                  columns=PassTuple._fields, table='passes'):
+    """Return the SQL and arguments selecting the given PassTuple columns
+    of the matching passes, for the schema version of `conn`.  `table` is
+    the partition to select from in a partitioned database.
+    """
+    for c in columns:
+        if c not in PassTuple._fields:
+            raise KeyError('Unknown pass column: {}'.format(c))
+
+    version = passes_db_version(conn)
+    args = []
+    conditions = []
+
+    if version == 0:
+        query = 'SELECT {} FROM passes'.format(', '.join(columns))
+        for (name, var) in (('gs', gs), ('norad', sat),):
+            if var is not None:
+                conditions.append('{} GLOB ?'.format(name))
+                args.append(var)
+
+        # return passes which overlap the end points
+        if start is not None:
+            conditions.append("end >= datetime(?)")
+            args.append(start)
+
+        if end is not None:
+            conditions.append("start <= datetime(?)")
+            args.append(end)
+
+    elif version in (PASSES_SCHEMA_VERSION, PARTITIONED_SCHEMA_VERSION):
+        query = 'SELECT {} FROM {} AS p'.format(', '.join(
+            's.name' if c == 'gs' else 'p.' + c for c in columns), table)
+        # station names are only needed when returned
+        if 'gs' in columns:
+            query += ' JOIN stations AS s ON s.id = p.gs'
+        if gs is not None:
+            conditions.append(
+                'p.gs IN (SELECT id FROM stations WHERE name GLOB ?)')
+            args.append(gs)
+        if sat is not None:
+            conditions.append('p.norad GLOB ?')
+            args.append(sat)
+
+        # return passes which overlap the end points
+        if start is not None:
+            conditions.append('p.end >= ' + SQL_EPOCH_MS.format('?'))
+            args.append(start)
+            # no pass is longer than this, so the start column bounds the
+            # search on both sides and the time indexes give a range scan
+            row = conn.execute('''SELECT value FROM passes_meta
+                                  WHERE key = 'max_duration';''').fetchone()
+            if row is not None and row[0] is not None:
+                conditions.append(
+                    'p.start >= ' + SQL_EPOCH_MS.format('?') + ' - ?')
+                args.extend((start, row[0]))
+
+        if end is not None:
+            conditions.append('p.start <= ' + SQL_EPOCH_MS.format('?'))
+            args.append(end)
+
+    else:
+        raise ValueError('Unknown passes database version {}'.format(version))
+
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query, args
+
+
+def iterpasses(passes_db=None, gs=None, sat=None, start=None, end=None,
+               columns=PassTuple._fields, epoch_ms=False, arrays=False,
+               batch_size=10000):
+    """Generate matching passes from the database without building a tree.
+
+    Selection arguments are the same as getpasses().  Only the requested
+    columns are read and rows are fetched `batch_size` at a time.
+
+    Parameters
+    ----------
+    columns : sequence of str
+        PassTuple field names to return, in order.
+    epoch_ms : bool
+        Return times as integer milliseconds since the Unix epoch instead of
+        datetimes.
+    arrays : bool
+        Yield one dict of column name to NumPy array per batch instead of
+        one tuple per pass.  Times are int64 epoch milliseconds.
+    batch_size : int
+        Number of rows per fetchmany().
+
+    Yields
+    ------
+    tuple or dict
+        Plain tuples of the requested columns, or dicts of column arrays.
+    """
+    passes_db = passes_db or config['DEFAULT']['passes_db']
+    columns = tuple(columns)
+    if arrays:
+        epoch_ms = True
+
+    conn = connections.get(passes_db)
+    version = passes_db_version(conn)
+    if version == PARTITIONED_SCHEMA_VERSION:
+        # only the partitions overlapping the time range are read
+        tables = _partitions(
+            conn,
+            None if start is None else _epoch_ms_arg(conn, start),
+            None if end is None else _epoch_ms_arg(conn, end))
+    else:
+        tables = ['passes']
+    # version 0 stores datetimes, later versions epoch milliseconds
+    stored_ms = version != 0
+    convert = None
+    if stored_ms != epoch_ms:
+        convert = from_epoch_ms if stored_ms else to_epoch_ms
+    times = [k for k, c in enumerate(columns) if c in TIME_COLUMNS]
+
+    for table in tables:
+        query, args = _passes_query(conn, gs=gs, sat=sat, start=start,
+                                    end=end, columns=columns, table=table)
+        yield from _fetch_passes(conn.execute(query, args), batch_size,
+                                 convert, times, columns, arrays)
+
+
+def _fetch_passes(cur, batch_size, convert, times, columns, arrays):
+    """Rows of a passes query for iterpasses()."""
+    if arrays:
+        import numpy as np
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+
+        if convert is not None and times:
+            converted = []
+            for row in rows:
+                row = list(row)
+                for k in times:
+                    row[k] = convert(row[k])
+                converted.append(tuple(row))
+            rows = converted
+
+        if arrays:
+            yield {c: np.array(col) for c, col in zip(columns, zip(*rows))}
+        else:
+            yield from rows
+
+
+def getpasses(passes_db=None, gs=None, sat=None, start=None, end=None,
+              as_array=False):
     """Retrieve all matching Satellite--Ground passes from the database.
 
     Unspecified arguments match all values.  Set `start` == `end` to select
-    passes which overlap a time instant.
+    passes which overlap a time instant.  In a partitioned database only the
+    partitions overlapping `start` and `end` are read.  See iterpasses() to
+    stream the passes instead.
 
     Parameters
     ----------
@@ -408,47 +863,126 @@ def getpasses(passes_db=None, gs=None, sat=None, start=None, end=None):
     gs : str
         Glob string selecting a Ground Station name.
     sat : int
-        Glob selecting satellite(s).
+        Glob selecting satellite(s) by NORAD number.
     start : datetime or SQlite3 datetime string
         Select passes which end on or after `start` time.
     end : datetime or SQlite3 datetime string
         Select passes which start on or before `end` time.
+    as_array : bool
+        Return a `passarray.PassArray` loaded in bulk instead of a tree.
 
     Returns
     -------
     IntervalTree
         All matching passes from the database with `.data` set to a `PassTuple`.
     """
-    passes_db = passes_db or config['DEFAULT']['passes_db']
-    tree = IntervalTree()
+    rows = iterpasses(passes_db, gs=gs, sat=sat, start=start, end=end,
+                      epoch_ms=as_array)
+    if as_array:
+        from satbazaar.passarray import PassArray
+        return PassArray.from_rows(rows)
 
-    conn = sqlite3.connect('file:' + passes_db + '?mode=ro',
-                           uri=True,
-                           detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
+    tree = IntervalTree()
+    for row in rows:
+        d = PassTuple._make(row)
+        tree.addi(d.start, d.end, d)
+    return tree
 
-    query = 'SELECT * FROM passes'
-    args = []
-    conditions = []
-    for (name, var) in (('gs', gs), ('sat', sat),):
-        if var is not None:
-            conditions.append('{} GLOB ?'.format(name))
-            args.append(var)
 
-    # return passes which overlap the end points
-    if start is not None:
-        conditions.append("end >= datetime('{}')".format(start))
+def export_passes(directory, passes_db=None, gs=None, sat=None, start=None,
+                  end=None):
+    """Write the matching passes to a directory of NumPy column files for
+    load_passes(), see passarray.PassArray.save() for the layout.
 
-    if end is not None:
-        conditions.append("start <= datetime('{}')".format(end))
+    Selection arguments are the same as getpasses().  Returns the number of
+    passes written.
+    """
+    import numpy as np
+    from satbazaar.passarray import PassArray
+
+    batches = list(iterpasses(passes_db, gs=gs, sat=sat, start=start,
+                              end=end, arrays=True))
+    if batches:
+        cols = {c: np.concatenate([b[c] for b in batches])
+                for c in PassTuple._fields}
+        names, codes = np.unique(cols['gs'], return_inverse=True)
+        cols['gs'] = codes
+        passes = PassArray(*(cols[c] for c in PassTuple._fields),
+                           gs_names=names.tolist())
+    else:
+        passes = PassArray(*([] for _ in PassTuple._fields), gs_names=())
+    passes.save(directory)
+    return len(passes)
+
+
+def _glob_matches(conn, values, pattern):
+    """The values matching an SQLite GLOB pattern."""
+    return [v for v in values
+            if conn.execute('SELECT ? GLOB ?;', (str(v), str(pattern)))
+                   .fetchone()[0]]
+
+
+def _epoch_ms_arg(conn, t):
+    """Epoch milliseconds of a datetime or SQLite datetime string argument
+    of getpasses()."""
+    if isinstance(t, datetime):
+        return to_epoch_ms(t)
+    ms = conn.execute('SELECT ' + SQL_EPOCH_MS.format('?') + ';',
+                      (t,)).fetchone()[0]
+    if ms is None:
+        raise ValueError('Invalid time: {!r}'.format(t))
+    return ms
+
+
+def load_passes(directory, gs=None, sat=None, start=None, end=None,
+                mmap_mode='r'):
+    """Passes from a directory written by export_passes() as a
+    `passarray.PassArray`.
+
+    The columns are memory-mapped, so loading doesn't read the data, and
+    the selection arguments of getpasses() are applied as array masks with
+    the same meaning, including the GLOB patterns.  Without a selection, or
+    with only `end`, the result shares the memory-mapped columns.
+    """
+    import numpy as np
+    from satbazaar.passarray import PassArray
 
-    if conditions:
-        query += ' WHERE ' + ' AND '.join(conditions)
+    passes = PassArray.load(directory, mmap_mode)
+    if gs is None and sat is None and start is None and end is None:
+        return passes
 
-    for p in conn.execute(query, args):
-        tree.add(passrow2interval(p))
-    conn.close()
-    return tree
+    conn = sqlite3.connect(':memory:')
+    try:
+        lo, hi = 0, len(passes)
+        if end is not None:
+            # sorted by start
+            hi = int(np.searchsorted(passes.start_ms, _epoch_ms_arg(conn, end),
+                                     side='right'))
+        if start is not None:
+            b = _epoch_ms_arg(conn, start)
+            # passes before lo all end before start
+            lo = min(hi, int(np.searchsorted(passes._maxend, b, side='left')))
+
+        mask = None
+        if start is not None:
+            mask = passes.end_ms[lo:hi] >= b
+        if gs is not None:
+            names = set(_glob_matches(conn, passes.gs_names, gs))
+            codes = [i for i, name in enumerate(passes.gs_names)
+                     if name in names]
+            m = np.isin(passes.gs[lo:hi], codes)
+            mask = m if mask is None else mask & m
+        if sat is not None:
+            norads = _glob_matches(conn, PassArray.load_meta(directory)['norads'],
+                                   sat)
+            m = np.isin(passes.norad[lo:hi], norads)
+            mask = m if mask is None else mask & m
+    finally:
+        conn.close()
+
+    if mask is None or mask.all():
+        return passes[lo:hi]
+    return passes[lo + np.flatnonzero(mask)]
 
 
 def compute_passes_ephem(args):
@@ -456,7 +990,8 @@ def compute_passes_ephem(args):
     uses PyEphem library
 
     Arguments:
-    observer -- 4 element list containing desired [name,lat,lon,alt]
+    observer -- station dict, or a sequence of station dicts to compute all
+                of them against a single parsed TLE
     tle -- 3 element list containing desired tle [line0,line1,line2]
     start_time -- ephem.date string formatted 'yyyy/mm/dd hr:min:sec'
     num_passes -- integer number of desired passes (defualt None)
@@ -467,11 +1002,23 @@ def compute_passes_ephem(args):
     If neither, find passes for next 24 hours.
     """
     (observer, satellite, start_time, num_passes, duration) = args
-    # s = "%s <--> %s | " % (observer['name'], satellite['name'].strip())
-    s = "%3i <--> %5i | " % (observer['id'], satellite['norad_cat_id'])
 
-    tle_line0, tle_line1, tle_line2 = satellite['tle']
+    # Read in most recent satellite TLE data
+    sat = ephem.readtle(*satellite['tle'])
+
+    if isinstance(observer, Mapping):
+        return _ephem_passes(observer, satellite, sat,
+                             start_time, num_passes, duration)
+
+    data = []
+    for o in observer:
+        data.extend(_ephem_passes(o, satellite, sat,
+                                  start_time, num_passes, duration))
+    return data
+
 
+def _ephem_passes(observer, satellite, sat, start_time, num_passes, duration):
+    """Passes of an already parsed ephem body over one station."""
     # Set up location of observer
     ground_station = ephem.Observer()
     ground_station.name = observer['name']        # name string
@@ -482,9 +1029,6 @@ def compute_passes_ephem(args):
     ground_station.horizon = str(observer['min_horizon'])  # in degrees
     ground_station.pressure = 0  # ignore atmospheric refraction at the horizon
 
-    # Read in most recent satellite TLE data
-    sat = ephem.readtle(tle_line0, tle_line1, tle_line2)
-
     contacts = []
 
     if duration is None and num_passes is None:
@@ -524,14 +1068,11 @@ def compute_passes_ephem(args):
             info = ground_station.next_pass(sat)
         except ValueError:
             # could not find a rise time
-            s += 'E'
-            print(s)
             # print('pyephem: ValueError')
             return []
 
         # check None indicating libastro NORISE, NOSET, NOTRANS flags
         if not all(info):
-            s += 'F'
             # print('pyephem: NORISE NOSET NOTRANS')
             # keep looking
             ground_station.date = ground_station.date + ephem.minute
@@ -565,15 +1106,11 @@ def compute_passes_ephem(args):
             # update current time
             ground_station.date = set_time
             contacts.append(pass_data)
-            s += '.'
-        else:
-            s += 'N'
-            # print('pyephem: AOS > LOS')
+        # else pyephem: AOS > LOS, drop it
 
         # increase by 1 min and look for next pass
         ground_station.date = ground_station.date + ephem.minute
 
-    print(s)
     # convert to namedtuples since the info doesn't change
     data = []
     for p in contacts:
@@ -600,7 +1137,6 @@ def compute_passes_orbital(args):
     from pyorbital.orbital import Orbital
 
     (observer, satellite, start_time, num_passes, duration) = args
-    print("%s <--> %s" % (observer['name'], satellite['name'].strip()), flush=True)
 
     tle = satellite['tle']
 
@@ -670,68 +1206,817 @@ def compute_passes_orbital(args):
     return data
 
 
+PASS_INSERT = 'INSERT INTO passes VALUES (?,?,?,?,?,?,?,?,?);'
+PARTITION_INSERT = 'INSERT INTO {} VALUES (?,?,?,?,?,?,?,?,?);'
+SOURCE_INSERT = 'INSERT OR REPLACE INTO pass_sources VALUES (?,?,?,?,?,?,?,?,?);'
+
+
+def _create_pass_table(cur, table='passes'):
+    """Create a table of passes, or a partition of them, and its indexes."""
+    # column order needs to match PassTuple order
+    # times are integer milliseconds since the Unix epoch
+    cur.execute('''CREATE TABLE IF NOT EXISTS {}
+              (start integer,
+              end integer,
+              duration real,
+              rise_az real,
+              set_az real,
+              tca integer,
+              max_el real,
+              gs integer REFERENCES stations (id),
+              norad integer);'''.format(table))
+    prefix = 'idx_' if table == 'passes' else 'idx_{}_'.format(table)
+    cur.execute('''CREATE INDEX IF NOT EXISTS {0}gs_start_end
+                   ON {1} (gs, start, end);'''.format(prefix, table))
+    cur.execute('''CREATE INDEX IF NOT EXISTS {0}start_end
+                   ON {1} (start, end);'''.format(prefix, table))
+    cur.execute('''CREATE INDEX IF NOT EXISTS {0}norad_start
+                   ON {1} (norad, start);'''.format(prefix, table))
+
+
+def _create_passes_tables(cur, partition_ms=None):
+    """Create the passes table and its bookkeeping if they do not exist.
+
+    With partition_ms the passes go into one table per that many
+    milliseconds instead, created as needed by _insert_passes().
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS stations
+              (id integer PRIMARY KEY,
+              name text UNIQUE NOT NULL);''')
+
+    if partition_ms is None:
+        _create_pass_table(cur)
+    else:
+        # passes start in [begin, end), max_end and max_duration are NULL
+        # while a partition is empty
+        cur.execute('''CREATE TABLE IF NOT EXISTS pass_partitions
+                  (name text PRIMARY KEY,
+                  begin integer,
+                  end integer,
+                  max_end integer,
+                  max_duration integer,
+                  count integer);''')
+
+    # inputs used to compute the rows of each pair, see update_passes()
+    cur.execute('''CREATE TABLE IF NOT EXISTS pass_sources
+              (gs integer REFERENCES stations (id),
+              norad integer,
+              epoch integer,
+              lat real,
+              lon real,
+              alt real,
+              min_horizon real,
+              start integer,
+              end integer,
+              PRIMARY KEY (gs, norad));''')
+
+    # the longest pass bounds time range queries, see _passes_query()
+    cur.execute('''CREATE TABLE IF NOT EXISTS passes_meta
+              (key text PRIMARY KEY,
+              value);''')
+    if partition_ms is None:
+        version = PASSES_SCHEMA_VERSION
+    else:
+        version = PARTITIONED_SCHEMA_VERSION
+        cur.execute('''INSERT OR REPLACE INTO passes_meta
+                       VALUES ('partition_ms', ?);''', (partition_ms,))
+    cur.execute('PRAGMA user_version = {};'.format(version))
+
+
+def _update_passes_meta(cur, partitions=None):
+    """Refresh the summary values after the passes changed.  In a
+    partitioned database only the named partitions are refreshed, or all
+    of them if None."""
+    if passes_db_version(cur.connection) != PARTITIONED_SCHEMA_VERSION:
+        cur.execute('''INSERT OR REPLACE INTO passes_meta
+                       VALUES ('max_duration',
+                               (SELECT max(end - start) FROM passes));''')
+        return
+
+    if partitions is None:
+        partitions = _partitions(cur.connection)
+    for name in partitions:
+        cur.execute('''UPDATE pass_partitions
+                       SET (max_end, max_duration, count) =
+                           (SELECT max(end), max(end - start), count(*)
+                            FROM {0})
+                       WHERE name = ?;'''.format(name), (name,))
+    cur.execute('''INSERT OR REPLACE INTO passes_meta
+                   VALUES ('max_duration',
+                           (SELECT max(max_duration)
+                            FROM pass_partitions));''')
+
+
+def passes_partition_ms(conn):
+    """Length of the partitions of an open passes database in
+    milliseconds, None if it isn't partitioned."""
+    if passes_db_version(conn) != PARTITIONED_SCHEMA_VERSION:
+        return None
+    return conn.execute('''SELECT value FROM passes_meta
+                           WHERE key = 'partition_ms';''').fetchone()[0]
+
+
+def _partition_begin(start, partition_ms):
+    """Start of the partition holding a pass starting at `start`, both in
+    epoch milliseconds.  Weeks start on Mondays, the epoch is a Thursday."""
+    origin = 4 * DAY_MS if partition_ms % (7 * DAY_MS) == 0 else 0
+    return start - (start - origin) % partition_ms
+
+
+def _partitions(conn, start=None, end=None):
+    """Names of the partitions, oldest first, which may hold passes
+    overlapping [start, end] in epoch milliseconds.  Empty partitions
+    never match a range."""
+    query = 'SELECT name FROM pass_partitions'
+    conditions = []
+    args = []
+    if start is not None:
+        conditions.append('max_end >= ?')
+        args.append(start)
+    if end is not None:
+        conditions.append('begin <= ?')
+        args.append(end)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return [name for (name,) in conn.execute(query + ' ORDER BY begin;', args)]
+
+
+def _partition_name(begin):
+    """Table name of the partition starting at `begin` epoch milliseconds."""
+    return 'passes_' + from_epoch_ms(begin).strftime('%Y%m%d')
+
+
+def _create_partition(cur, begin, partition_ms):
+    """Create the partition starting at `begin` if it doesn't exist, and
+    return its name."""
+    name = _partition_name(begin)
+    _create_pass_table(cur, name)
+    cur.execute('''INSERT OR IGNORE INTO pass_partitions
+                   VALUES (?, ?, ?, NULL, NULL, 0);''',
+                (name, begin, begin + partition_ms))
+    return name
+
+
+def _insert_passes(cur, rows, partition_ms=None, touched=None):
+    """Insert rows of the passes table, or into the partitions of their
+    start times, creating them as needed.  The names of the partitions
+    written to are added to the set `touched`."""
+    if partition_ms is None:
+        cur.executemany(PASS_INSERT, rows)
+        return
+
+    bybegin = defaultdict(list)
+    for row in rows:
+        bybegin[_partition_begin(row[0], partition_ms)].append(row)
+    for begin, part in bybegin.items():
+        name = _partition_name(begin)
+        if touched is None or name not in touched:
+            _create_partition(cur, begin, partition_ms)
+        cur.executemany(PARTITION_INSERT.format(name), part)
+        if touched is not None:
+            touched.add(name)
+
+
+def _station_ids(cur, names):
+    """Return a dict of station name to id, adding unknown names."""
+    cur.executemany('INSERT OR IGNORE INTO stations (name) VALUES (?);',
+                    ((name,) for name in names))
+    return dict(cur.execute('SELECT name, id FROM stations;'))
+
+
+def _passrow(d, gs_ids):
+    """Row for the passes table from a PassTuple."""
+    start = to_epoch_ms(d.start)
+    # grazing passes shorter than the resolution keep a non-zero length
+    end = max(to_epoch_ms(d.end), start + 1)
+    return (start,
+            end,
+            d.duration,
+            d.rise_az,
+            d.set_az,
+            to_epoch_ms(d.tca),
+            d.max_el,
+            gs_ids[d.gs],
+            d.norad)
+
+
+def migrate_passes_db(passes_db=None, partition=None):
+    """Convert a passes database to the current schema in place.
+
+    Version 0 files, with timestamp text columns, are rewritten to integer
+    epoch milliseconds with station ids and the time indexes.  With
+    partition 'day' or 'week' the passes are then split into one table per
+    day or week of start time.  Does nothing if the file is already current,
+    a partitioned file stays as it is.
+
+    Returns the version the file had.
+    """
+    passes_db = passes_db or config['DEFAULT']['passes_db']
+
+    conn = sqlite3.connect('file:' + passes_db, uri=True)
+    # manage the transaction by hand so the DDL is part of it
+    conn.isolation_level = None
+    cur = conn.cursor()
+    version = passes_db_version(conn)
+    if (version == PARTITIONED_SCHEMA_VERSION
+            or (version == PASSES_SCHEMA_VERSION and partition is None)):
+        conn.close()
+        return version
+    if version == PASSES_SCHEMA_VERSION:
+        cur.execute('BEGIN;')
+        _partition_passes_table(cur, PARTITION_SIZES[partition])
+        cur.execute('COMMIT;')
+        conn.close()
+        return version
+    if version != 0:
+        conn.close()
+        raise ValueError('Unknown passes database version {}'.format(version))
+
+    tables = {name for (name,) in cur.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table';")}
+
+    cur.execute('BEGIN;')
+    if 'passes' in tables:
+        for index in ('idx_gs', 'idx_norad', 'idx_gs_norad'):
+            cur.execute('DROP INDEX IF EXISTS {};'.format(index))
+        cur.execute('ALTER TABLE passes RENAME TO passes_v0;')
+    if 'pass_sources' in tables:
+        cur.execute('ALTER TABLE pass_sources RENAME TO pass_sources_v0;')
+
+    _create_passes_tables(cur)
+
+    ms = SQL_EPOCH_MS.format
+    if 'passes' in tables:
+        cur.execute('''INSERT OR IGNORE INTO stations (name)
+                       SELECT DISTINCT gs FROM passes_v0;''')
+        cur.execute('''INSERT INTO passes
+                       SELECT {0}, max({1}, {0} + 1), p.duration,
+                              p.rise_az, p.set_az, {2}, p.max_el, s.id, p.norad
+                       FROM passes_v0 AS p
+                       JOIN stations AS s ON s.name = p.gs;'''.format(
+                           ms('p.start'), ms('p.end'), ms('p.tca')))
+        cur.execute('DROP TABLE passes_v0;')
+    if 'pass_sources' in tables:
+        cur.execute('''INSERT OR IGNORE INTO stations (name)
+                       SELECT DISTINCT gs FROM pass_sources_v0;''')
+        cur.execute('''INSERT INTO pass_sources
+                       SELECT s.id, p.norad, {}, p.lat, p.lon, p.alt,
+                              p.min_horizon, {}, {}
+                       FROM pass_sources_v0 AS p
+                       JOIN stations AS s ON s.name = p.gs;'''.format(
+                           ms('p.epoch'), ms('p.start'), ms('p.end')))
+        cur.execute('DROP TABLE pass_sources_v0;')
+
+    _update_passes_meta(cur)
+    if partition is not None:
+        _partition_passes_table(cur, PARTITION_SIZES[partition])
+    cur.execute('COMMIT;')
+    conn.close()
+    return version
+
+
+def _partition_passes_table(cur, partition_ms):
+    """Move the rows of the passes table into partitions and drop it."""
+    _create_passes_tables(cur, partition_ms)
+    origin = _partition_begin(0, partition_ms)
+    begins = [begin for (begin,) in cur.execute(
+        '''SELECT DISTINCT start - (start - ?) % ? FROM passes;''',
+        (origin, partition_ms))]
+    touched = set()
+    for begin in begins:
+        name = _create_partition(cur, begin, partition_ms)
+        cur.execute('''INSERT INTO {} SELECT * FROM passes
+                       WHERE start >= ? AND start < ?;'''.format(name),
+                    (begin, begin + partition_ms))
+        touched.add(name)
+    cur.execute('DROP TABLE passes;')
+    _update_passes_meta(cur, touched)
+
+
+def _drop_passes_tables(cur):
+    """Drop the passes, or all partitions, and the bookkeeping tables."""
+    tables = {name for (name,) in cur.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table';")}
+    if 'pass_partitions' in tables:
+        for (name,) in cur.execute('SELECT name FROM pass_partitions;').fetchall():
+            cur.execute('DROP TABLE IF EXISTS {};'.format(name))
+    for table in ('passes', 'pass_partitions', 'pass_sources', 'passes_meta',
+                  'stations'):
+        cur.execute('DROP TABLE IF EXISTS {};'.format(table))
+
+
+def drop_passes(before, passes_db=None):
+    """Drop the partitions of a partitioned passes database whose passes
+    all end before `before`, a datetime or SQLite datetime string.
+
+    Each partition is a table, so this costs the same however many passes
+    it held.  The windows in pass_sources are moved up to the end of the
+    dropped partitions, so update_passes() recomputes them if asked for
+    the dropped time again.  Returns the number of partitions dropped.
+    """
+    passes_db = passes_db or config['DEFAULT']['passes_db']
+    conn = connections.get(passes_db, readonly=False)
+    if passes_partition_ms(conn) is None:
+        raise ValueError('Passes database is not partitioned: {}'.format(
+            passes_db))
+    cutoff = _epoch_ms_arg(conn, before)
+
+    cur = conn.cursor()
+    dropped = cur.execute('''SELECT name, end FROM pass_partitions
+                             WHERE end <= ?
+                                   AND (max_end IS NULL OR max_end < ?);''',
+                          (cutoff, cutoff)).fetchall()
+    for name, end in dropped:
+        cur.execute('DROP TABLE {};'.format(name))
+        cur.execute('DELETE FROM pass_partitions WHERE name = ?;', (name,))
+    if dropped:
+        covered = max(end for name, end in dropped)
+        cur.execute('''UPDATE pass_sources SET start = ?, end = max(end, ?)
+                       WHERE start < ?;''', (covered, covered, covered))
+        _update_passes_meta(cur, ())
+    conn.commit()
+    connections.release(passes_db)
+    return len(dropped)
+
+
+def _window(start_time, duration):
+    """Return (start, end) datetimes of a computation window, with the same
+    default duration as compute_passes_ephem().
+    """
+    start = ephem.date(start_time).datetime()
+    if duration is None:
+        duration = 24
+    return start, start + timedelta(hours=duration)
+
+
+def _search_window(start_time, num_passes, duration):
+    """Return (start, end) datetimes the pass search may cover, which is
+    five years when only num_passes limits it, as in compute_passes_ephem().
+    """
+    if duration is None and num_passes is not None:
+        duration = 5 * 365 * 24
+    return _window(start_time, duration)
+
+
+def _visibility_filter(prefilter):
+    """The visibility.VisibilityFilter to use for a prefilter argument."""
+    if prefilter is True:
+        from satbazaar import visibility
+        return visibility.default_filter
+    return prefilter or None
+
+
+def _pass_source(gs, satellite, start, end):
+    """Row for the pass_sources table describing one computed pair, with
+    the station name in place of its id.
+    """
+    return (gs['name'],
+            satellite['norad_cat_id'],
+            to_epoch_ms(TLE(satellite['tle']).epoch),
+            float(gs['lat']),
+            float(gs['lon']),
+            float(gs['altitude']),
+            float(gs['min_horizon']),
+            to_epoch_ms(start),
+            to_epoch_ms(end))
+
+
+def _store_passes(conn, results, gs_ids, tree=None, batch_size=10000,
+                  partition_ms=None, touched=None):
+    """Insert the PassTuples from an iterable of per-job lists as they
+    arrive, using executemany() and committing every `batch_size` rows.
+
+    Passes are also added to `tree` if one is given.  partition_ms and
+    touched are as for _insert_passes().
+
+    Returns a tuple of the number of jobs and passes stored.
+    """
+    cur = conn.cursor()
+    njobs = 0
+    npasses = 0
+    batch = []
+    for passdata in results:
+        njobs += 1
+        for d in passdata:
+            # IntervalTree refuses null intervals, keep the db consistent
+            if not d.start < d.end:
+                print('!!! Invalid pass !!!')
+                print(d.start)
+                print(d.end)
+                print(d)
+                continue
+            if tree is not None:
+                tree.addi(d.start, d.end, d)
+            batch.append(_passrow(d, gs_ids))
+
+        if len(batch) >= batch_size:
+            _insert_passes(cur, batch, partition_ms, touched)
+            conn.commit()
+            npasses += len(batch)
+            batch = []
+
+    _insert_passes(cur, batch, partition_ms, touched)
+    conn.commit()
+    npasses += len(batch)
+    return njobs, npasses
+
+
 def compute_all_passes(stations, satellites, start_time,
                        passes_db=None,
                        num_passes=None, duration=None,
-                       num_processes=4,
-                       compute_function=compute_passes_ephem):
+                       num_processes=None,
+                       compute_function=compute_passes_ephem,
+                       per_satellite=False,
+                       chunksize=1,
+                       batch_size=10000,
+                       return_tree=True,
+                       partition=None,
+                       prefilter=True):
     """Finds passes for all combinations of stations and satellites.
 
     Saves the pass info as rows in an sqlite3 database and returns the data as
     an IntervalTree with each data member set to the pass info as a namedtuple.
 
-    num_processes > 1 (default: 4) will use a parallel map() for computation.
+    The jobs run in a pool of num_processes workers, os.cpu_count() by
+    default, or in this process if num_processes is 1.  They are started
+    most expensive first, estimated from the mean motion and the station
+    latitudes, and handed out as workers become free; progress, per-worker
+    throughput and stragglers are printed instead of a line per job.
+
+    per_satellite=True makes each job one satellite against the list of all
+    stations, so the TLE is parsed and the orbit propagated once per satellite
+    instead of once per pair.  compute_function must then accept a sequence
+    of station dicts, as compute_passes_ephem() and
+    fastpass.compute_passes_numpy() do.
+
+    Results are written as they arrive from the workers, in no particular
+    order, so memory use does not grow with the horizon:
+
+    chunksize -- number of jobs handed to a worker at a time
+    batch_size -- rows per executemany() and commit
+    return_tree -- if False, skip building the IntervalTree and return the
+                   number of passes stored instead
+    partition -- 'day' or 'week' to store the passes in one table per day or
+                 week of start time, see drop_passes() and update_passes()
+    prefilter -- skip the pairs which can't have passes, see
+                 visibility.VisibilityFilter.  True uses the shared filter,
+                 or pass a filter or False.
     """
     passes_db = passes_db or config['DEFAULT']['passes_db']
+    partition_ms = PARTITION_SIZES[partition] if partition else None
 
-    conn = sqlite3.connect('file:' + passes_db, uri=True,
-                           detect_types=sqlite3.PARSE_DECLTYPES)
+    conn = connections.get(passes_db, readonly=False)
     cur = conn.cursor()
-    cur.execute('''DROP TABLE IF EXISTS passes;''')
+    _drop_passes_tables(cur)
+    _create_passes_tables(cur, partition_ms)
+
+    tree = IntervalTree() if return_tree else None
+
+    stations = list(stations)
+    satellites = list(satellites)
+    gs_ids = _station_ids(cur, (gs['name'] for gs in stations))
+    # a window cut short by num_passes can't be extended by update_passes()
+    sources = []
+    if num_passes is None:
+        window = _window(start_time, duration)
+        sources = [_pass_source(gs, sat, *window)
+                   for gs, sat in product(stations, satellites)]
+
+    # stations to search for each satellite
+    vf = _visibility_filter(prefilter)
+    searched = [(sat, stations) for sat in satellites]
+    if vf is not None:
+        window = _search_window(start_time, num_passes, duration)
+        searched = [(sat, vf.visible_stations(stations, sat, *window))
+                    for sat in satellites]
+        print('Prefilter skipped',
+              len(stations) * len(satellites)
+              - sum(len(gss) for _, gss in searched),
+              'of', len(stations) * len(satellites), 'Sat--GS pairs')
+
+    if per_satellite:
+        # one job per satellite, sharing its ephemeris across all stations
+        jobs = [(gss, sat) for sat, gss in searched if gss]
+    else:
+        jobs = [(gs, sat) for sat, gss in searched for gs in gss]
+
+    jobs = [(None, compute_function,
+             (observer, sat, start_time, num_passes, duration))
+            for observer, sat in jobs]
+    result = (passdata for _, passdata
+              in _run_jobs(jobs, num_processes, chunksize))
+    njobs, npasses = _store_passes(conn, result, gs_ids,
+                                   tree, batch_size, partition_ms)
+
+    print('Computed', njobs,
+          'satellites' if per_satellite else 'Sat--GS pairs')
+
+    cur.executemany(SOURCE_INSERT,
+                    ((gs_ids[r[0]],) + r[1:] for r in sources))
+    _update_passes_meta(cur)
+    conn.commit()
+    connections.release(passes_db)
+    print('%i passes' % npasses)
+    if return_tree:
+        return tree
+    return npasses
+
+
+# seconds between progress lines while computing passes
+PROGRESS_INTERVAL = 10
+# jobs taking this many times the median are reported as stragglers
+STRAGGLER_FACTOR = 5
+STRAGGLERS_SHOWN = 5
+# weight of the passes against the propagation in _job_cost(), a
+# compromise between compute_passes_ephem() which hardly depends on them and
+# the root finding of fastpass and adaptivepass
+COST_PASS_WEIGHT = 0.2
+# smallest sin^2 spread between inclination and latitude in _job_cost(),
+# bounds the weight of a station right under the turning latitude
+COST_MIN_SPREAD = 0.01
+
+
+def _job_cost(jobargs):
+    """Rough relative cost of a pass search job, to start the longest ones
+    first.
+
+    The search steps through the window a fixed fraction of an orbit at a
+    time, so it grows with the mean motion and the window, and every pass
+    found costs some more.  Ground tracks bunch up towards the latitude of
+    the inclination, so stations near it see the most passes, and those
+    well outside it only pay for the propagation.  A search for num_passes
+    passes runs for as many orbits as it takes to find them, so it is
+    costed per pass whatever the mean motion.
+    """
+    observer, satellite, _, num_passes, duration = jobargs
+    observers = [observer] if isinstance(observer, Mapping) else observer
+    tle = TLE(satellite['tle'])
+    if duration is None and num_passes is not None:
+        scale = 24 * num_passes
+    else:
+        scale = tle.mean_motion * (24 if duration is None else duration)
+    sin_i = sin(radians(min(tle.inclination, 180 - tle.inclination)))
+    cost = 0.0
+    for gs in observers:
+        spread = sin_i**2 - sin(radians(float(gs['lat'])))**2
+        cost += 1
+        if spread > 0:
+            cost += COST_PASS_WEIGHT / sqrt(max(spread, COST_MIN_SPREAD))
+    return scale * cost
+
+
+def _job_label(jobargs):
+    """Station and satellite of a job, for the progress report."""
+    observer, satellite = jobargs[:2]
+    if isinstance(observer, Mapping):
+        gs = observer['name']
+    else:
+        gs = '%i GS' % len(observer)
+    return '%s <--> %s' % (gs, satellite['norad_cat_id'])
 
-    # column order needs to match PassTuple order
-    cur.execute('''CREATE TABLE passes
-              (start timestamp,
-              end timestamp,
-              duration real,
-              rise_az real,
-              set_az real,
-              tca timestamp,
-              max_el real,
-              gs text,
-              norad integer);''')
-    cur.execute('''CREATE INDEX idx_gs ON passes (gs);''')
-    cur.execute('''CREATE INDEX idx_norad ON passes (norad);''')
-    cur.execute('''CREATE INDEX idx_gs_norad ON passes (gs, norad);''')
 
-    tree = IntervalTree()
+def _timed_job(args):
+    """Run compute_function on a job and tag the result with the job's
+    index, the worker's pid and the seconds it took, so results arriving
+    out of order can be matched to their job and reported on.
+    """
+    index, compute_function, jobargs = args
+    t = time.perf_counter()
+    result = compute_function(jobargs)
+    return index, os.getpid(), time.perf_counter() - t, result
 
-    jobargs = product(stations,
-                      satellites,
-                      (start_time,),  # single args are repeated
-                      (num_passes,),
-                      (duration,))
 
-    if num_processes > 1:
-        with multiprocessing.Pool(num_processes) as pool:
-            result = pool.map(compute_function, jobargs)
-    else:
-        result = list(map(compute_function, jobargs))
+class _Progress:
+    """Prints the progress of a set of jobs every `interval` seconds as
+    their results arrive, and on report() the throughput of each worker
+    and the jobs which took much longer than the median.
+    """
+    def __init__(self, njobs, interval=PROGRESS_INTERVAL):
+        self.njobs = njobs
+        self.interval = interval
+        self.start = self.last = time.perf_counter()
+        self.done = 0
+        # pid -> [jobs, passes, busy seconds]
+        self.workers = OrderedDict()
+        self.times = []
+
+    def add(self, label, worker, seconds, npasses):
+        self.done += 1
+        stats = self.workers.setdefault(worker, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += npasses
+        stats[2] += seconds
+        self.times.append((seconds, label))
+
+        now = time.perf_counter()
+        if now - self.last >= self.interval and self.done < self.njobs:
+            self.last = now
+            elapsed = now - self.start
+            print('%i/%i jobs %3.0f%%, %.0f s elapsed, ~%.0f s left'
+                  % (self.done, self.njobs, 100 * self.done / self.njobs,
+                     elapsed, elapsed * (self.njobs / self.done - 1)),
+                  flush=True)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        print('%i jobs in %.1f s on %i workers'
+              % (self.done, elapsed, len(self.workers)))
+        for k, (jobs, passes, busy) in enumerate(self.workers.values()):
+            print('  worker %i: %5i jobs %7i passes, %5.1f%% busy, '
+                  '%.1f jobs/s %.0f passes/s'
+                  % (k, jobs, passes, 100 * busy / elapsed if elapsed else 0,
+                     jobs / busy if busy else 0,
+                     passes / busy if busy else 0))
+        if len(self.times) < 2:
+            return
+        median = statistics.median(t for t, _ in self.times)
+        slow = sorted((t for t in self.times
+                       if t[0] > STRAGGLER_FACTOR * median), reverse=True)
+        for seconds, label in slow[:STRAGGLERS_SHOWN]:
+            print('  straggler: %s took %.2f s, %.0fx the median'
+                  % (label, seconds, seconds / median if median else 0))
+        if len(slow) > STRAGGLERS_SHOWN:
+            print('  ... and %i more stragglers'
+                  % (len(slow) - STRAGGLERS_SHOWN))
+
+
+def _run_jobs(jobs, num_processes=None, chunksize=1):
+    """Run (key, compute_function, jobargs) jobs and yield (key, result)
+    as the results arrive.
+
+    The jobs are started most expensive first, as estimated by _job_cost(),
+    and handed out one chunk at a time to whichever worker is free, so a
+    long job doesn't hold up a queue of short ones behind it.  Uses
+    os.cpu_count() processes by default, or runs in this process if
+    num_processes is 1.  Progress, per-worker throughput and stragglers
+    are printed along the way.
+    """
+    jobs = sorted(jobs, key=lambda job: _job_cost(job[2]), reverse=True)
+    tasks = [(k, compute_function, jobargs)
+             for k, (_, compute_function, jobargs) in enumerate(jobs)]
+    num_processes = num_processes or os.cpu_count() or 1
+    print('Running', len(jobs), 'jobs in',
+          num_processes, 'processes' if num_processes > 1 else 'process')
+    progress = _Progress(len(jobs))
+
+    def collect(results):
+        for index, worker, seconds, result in results:
+            key, _, jobargs = jobs[index]
+            progress.add(_job_label(jobargs), worker, seconds, len(result))
+            yield key, result
+        progress.report()
+
+    if num_processes == 1:
+        yield from collect(map(_timed_job, tasks))
+        return
+    with multiprocessing.Pool(num_processes) as pool:
+        yield from collect(pool.imap_unordered(_timed_job, tasks, chunksize))
+
+
+def update_passes(stations, satellites, start_time,
+                  passes_db=None,
+                  duration=None,
+                  num_processes=None,
+                  compute_function=compute_passes_ephem,
+                  chunksize=1,
+                  batch_size=10000,
+                  partition=None,
+                  prefilter=True):
+    """Bring an existing passes database up to date without recomputing
+    everything.
+
+    The pass_sources table records the TLE epoch, station lat/lon/alt/
+    min_horizon and time window used for each (gs, norad) pair.  For each
+    combination of the given stations and satellites:
+
+    - new pairs, or pairs whose TLE or station changed, are recomputed and
+      their old rows replaced
+    - unchanged pairs whose window ends before the requested one are only
+      computed from the old end forward
+    - everything else is left alone
+
+    Pairs in the database but not in the arguments are kept as they are.
+    Creates the database if needed, and migrates an older schema with
+    migrate_passes_db(), partitioned if `partition` is given.  In a
+    partitioned database the new passes go into the partitions of their
+    start times, so extending the horizon leaves the older partitions alone.
+    Pairs ruled out by the prefilter, as in compute_all_passes(), are
+    recorded as computed without running the pass search.
+    Returns the number of passes stored.
+    """
+    passes_db = passes_db or config['DEFAULT']['passes_db']
+    stations = list(stations)
+    satellites = list(satellites)
+    start, end = (to_epoch_ms(t) for t in _window(start_time, duration))
 
-    print('Computed', len(result), 'Sat--GS pairs')
+    migrate_passes_db(passes_db, partition)
+    conn = connections.get(passes_db, readonly=False)
+    cur = conn.cursor()
+    gs_ids = _station_ids(cur, (gs['name'] for gs in stations))
+    conn.commit()
 
-    for passdata in result:
-        for d in passdata:
-            try:
-                tree.addi(d.start, d.end, d)
-                cur.execute(
-                        'INSERT INTO passes VALUES (?,?,?,?,?,?,?,?,?);', d)
-            except ValueError:
-                print('!!! Invalid pass !!!')
-                print(d.start)
-                print(d.end)
-                print(d)
+    known = {}
+    for row in cur.execute('''SELECT s.name, p.norad, p.epoch, p.lat, p.lon,
+                                    p.alt, p.min_horizon, p.start, p.end
+                             FROM pass_sources AS p
+                             JOIN stations AS s ON s.id = p.gs;'''):
+        known[row[:2]] = row
+
+    partition_ms = passes_partition_ms(conn)
+    tables = ['passes'] if partition_ms is None else _partitions(conn)
+
+    # an extended window resumes after the last known pass of the pair, as
+    # compute_passes_ephem() may return a pass rising after its window
+    last_end = {}
+    for table in tables:
+        for (gs, norad, e) in cur.execute(
+                '''SELECT s.name, p.norad, max(p.end)
+                   FROM {} AS p JOIN stations AS s ON s.id = p.gs
+                   GROUP BY p.gs, p.norad;'''.format(table)):
+            last_end[gs, norad] = max(e, last_end.get((gs, norad), e))
+
+    def sourcerow(source):
+        return (gs_ids[source[0]],) + source[1:]
+
+    jobs = []
+    nskip = 0
+    for gs, sat in product(stations, satellites):
+        source = _pass_source(gs, sat, *_window(start_time, duration))
+        key = source[:2]
+        old = known.get(key)
+        if old is None or old[2:7] != source[2:7] or old[7] > start:
+            # new, changed, or asking for earlier passes than we have
+            jobs.append(((key, source, True),
+                         compute_function,
+                         (gs, sat, start_time, None, duration)))
+        elif old[8] < end:
+            resume = old[8]
+            if key in last_end:
+                # one minute past the last set, as compute_passes_ephem()
+                resume = max(resume, last_end[key] + 60000)
+            source = source[:7] + (old[7], end)
+            if resume < end:
+                hours = (end - resume) / 3600000
+                jobs.append(((key, source, False),
+                             compute_function,
+                             (gs, sat, from_epoch_ms(resume), None, hours)))
+            else:
+                # already covered, only the bookkeeping is behind
+                cur.execute(SOURCE_INSERT, sourcerow(source))
+        else:
+            nskip += 1
     conn.commit()
-    conn.close()
-    print('%i passes' % len(tree))
-    return tree
+
+    # pairs which can't have passes in their window are stored as empty
+    vf = _visibility_filter(prefilter)
+    ruled_out = []
+    if vf is not None:
+        from satbazaar.visibility import SEARCH
+        searched = []
+        for job in jobs:
+            gs, sat, job_start, _, hours = job[2]
+            if vf.classify(gs, sat, *_window(job_start, hours)) == SEARCH:
+                searched.append(job)
+            else:
+                ruled_out.append((job[0], []))
+        jobs = searched
+
+    print('Updating', len(jobs), 'Sat--GS pairs,', nskip, 'up to date,',
+          len(ruled_out), 'ruled out')
+
+    # partitions which were written to, only these need their summary
+    # refreshed so the others are left untouched
+    touched = set()
+
+    def store(results):
+        npasses = 0
+        pending = 0
+        for (key, source, replace), passdata in results:
+            rows = [_passrow(d, gs_ids) for d in passdata if d.start < d.end]
+            if replace:
+                for table in tables:
+                    cur.execute('''DELETE FROM {}
+                                   WHERE gs = ? AND norad = ?;'''.format(table),
+                                (gs_ids[key[0]], key[1]))
+                    if cur.rowcount:
+                        touched.add(table)
+            else:
+                seam = last_end.get(key)
+                rows = [r for r in rows if seam is None or r[0] > seam]
+            _insert_passes(cur, rows, partition_ms, touched)
+            cur.execute(SOURCE_INSERT, sourcerow(source))
+            npasses += len(rows)
+            pending += len(rows)
+            if pending >= batch_size:
+                conn.commit()
+                pending = 0
+        _update_passes_meta(cur, touched)
+        conn.commit()
+        return npasses
+
+    npasses = store(chain(ruled_out,
+                          _run_jobs(jobs, num_processes, chunksize)))
+    connections.release(passes_db)
+
+    print('%i passes' % npasses)
+    return npasses
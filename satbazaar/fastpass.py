@@ -0,0 +1,371 @@
+"""`fastpass` -- Vectorized satellite pass prediction
+=====================================================
+
+Propagates a satellite once over a grid of times with SGP4 and finds the
+rise and set times for any number of ground stations in one batched NumPy
+operation.  This is the approach described in
+`notes/fast-pass-prediction.adoc`:
+
+1. Step through time at 2 degrees of the orbit, as libastro does.
+2. Evaluate the elevation at every step for every station.
+3. A sign change of (elevation - min_horizon) brackets a rise or set.
+4. Refine each bracket, all at once, with bisection.
+
+`compute_passes_numpy()` is a drop-in `compute_function` for
+`db.compute_all_passes()` and returns the same `PassTuple` rows as
+`db.compute_passes_ephem()`.
+"""
+from collections.abc import Mapping
+from datetime import timedelta
+from math import pi
+
+import numpy as np
+import ephem
+
+from satbazaar.db import PassTuple
+
+
+# WGS-84 ellipsoid
+EARTH_RADIUS = 6378.137  # km
+EARTH_FLATTENING = 1 / 298.257223563
+EARTH_E2 = EARTH_FLATTENING * (2 - EARTH_FLATTENING)
+
+# offset between the Dublin Julian Day used by ephem.date and Julian Day
+DJD_TO_JD = 2415020.0
+
+# grid resolution, same as libastro's e_riset_cir()
+SAMPLES_PER_ORBIT = 180
+
+# number of (station, sample) elevations to evaluate at once, bounds memory
+# use to a few times (CHUNK_ELEMENTS * 3) doubles however many stations share
+# the ephemeris
+CHUNK_ELEMENTS = 2**18
+MIN_CHUNK_SAMPLES = 16
+
+# days past the end of the window to wait for a pass to set
+MAX_PASS_DAYS = 1.0
+
+# rise/set times are refined to this tolerance, in days (0.01 seconds)
+TIME_TOLERANCE = 0.01 / 86400
+
+deg_per_rad = 180.0 / pi
+
+
+def gmst(jd):
+    """Greenwich mean sidereal time (radians) for an array of UT1 Julian
+    Days using the IAU-82 model, as used by SGP4 for TEME.
+    """
+    tut1 = (jd - 2451545.0) / 36525.0
+    seconds = (67310.54841
+               + (876600.0 * 3600 + 8640184.812866) * tut1
+               + 0.093104 * tut1**2
+               - 6.2e-6 * tut1**3)
+    return np.remainder(seconds * (2 * pi / 86400.0), 2 * pi)
+
+
+def teme2ecef(r, jd):
+    """Rotate TEME position vectors (N, 3) to Earth-fixed coordinates,
+    ignoring polar motion.
+    """
+    theta = gmst(jd)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    out = np.empty_like(r)
+    out[..., 0] = c * r[..., 0] + s * r[..., 1]
+    out[..., 1] = -s * r[..., 0] + c * r[..., 1]
+    out[..., 2] = r[..., 2]
+    return out
+
+
+class StationArray:
+    """Earth-fixed positions and local east/north/up unit vectors for a
+    sequence of station dicts.
+    """
+    def __init__(self, observers):
+        self.observers = list(observers)
+        lat = np.radians([float(o['lat']) for o in self.observers])
+        lon = np.radians([float(o['lon']) for o in self.observers])
+        alt = np.array([float(o['altitude']) for o in self.observers]) / 1000
+        self.horizon = np.radians(
+            [float(o['min_horizon']) for o in self.observers])
+
+        slat, clat = np.sin(lat), np.cos(lat)
+        slon, clon = np.sin(lon), np.cos(lon)
+        n = EARTH_RADIUS / np.sqrt(1 - EARTH_E2 * slat**2)
+        self.position = np.stack((
+            (n + alt) * clat * clon,
+            (n + alt) * clat * slon,
+            (n * (1 - EARTH_E2) + alt) * slat), axis=-1)
+        self.east = np.stack((-slon, clon, np.zeros_like(lon)), axis=-1)
+        self.north = np.stack((-slat * clon, -slat * slon, clat), axis=-1)
+        self.up = np.stack((clat * clon, clat * slon, slat), axis=-1)
+
+    def __len__(self):
+        return len(self.observers)
+
+    def look(self, ecef, index=None):
+        """Return (azimuth, elevation) in radians of Earth-fixed positions.
+
+        With `index` None, `ecef` is (T, 3) and the result is (S, T) for all
+        stations.  Otherwise `ecef` is (N, 3) and `index` (N,) selects the
+        station for each position, and the result is (N,).
+        """
+        if index is None:
+            rho = ecef[None, :, :] - self.position[:, None, :]
+            east = self.east[:, None, :]
+            north = self.north[:, None, :]
+            up = self.up[:, None, :]
+        else:
+            rho = ecef - self.position[index]
+            east = self.east[index]
+            north = self.north[index]
+            up = self.up[index]
+        e = np.sum(rho * east, axis=-1)
+        n = np.sum(rho * north, axis=-1)
+        u = np.sum(rho * up, axis=-1)
+        el = np.arctan2(u, np.hypot(e, n))
+        az = np.remainder(np.arctan2(e, n), 2 * pi)
+        return az, el
+
+
+class Ephemeris:
+    """SGP4 propagator for one satellite which evaluates arrays of times
+    given as days after a reference Julian Day.
+    """
+    def __init__(self, tle, jd0):
+        from sgp4.api import Satrec
+
+        self.satrec = Satrec.twoline2rv(tle[1], tle[2])
+        self.jd0 = float(jd0)
+        self.whole = np.floor(self.jd0)
+        self.fraction = self.jd0 - self.whole
+        # count of propagated positions, handy for profiling
+        self.evaluations = 0
+
+    @property
+    def period(self):
+        """Orbital period in days."""
+        # no_kozai is in radians per minute
+        return 2 * pi / self.satrec.no_kozai / 1440
+
+    def ecef(self, t):
+        """Earth-fixed positions (N, 3) in km at times `t` (days after jd0).
+        Positions where SGP4 fails (decayed, etc.) are NaN.
+        """
+        t = np.asarray(t, dtype=float)
+        jd = np.full(t.shape, self.whole)
+        fr = self.fraction + t
+        err, r, _ = self.satrec.sgp4_array(jd, fr)
+        r[err != 0] = np.nan
+        self.evaluations += t.size
+        return teme2ecef(r, jd + fr)
+
+
+def _time_limits(start_time, num_passes, duration):
+    """Same defaults as db.compute_passes_ephem(); returns the window length
+    in days and the maximum number of passes per station.
+    """
+    if duration is None and num_passes is None:
+        duration = 24
+    if duration is None:
+        # longer than suggested length for TLEs
+        return 5 * 365, num_passes
+    return duration / 24, num_passes
+
+
+def _bisect(f, lo, hi, rising):
+    """Vectorized bisection for the zero crossing of f(t) bracketed
+    by [lo, hi].  `rising` is True where f goes from negative to positive.
+    """
+    lo = lo.copy()
+    hi = hi.copy()
+    while len(lo) and np.max(hi - lo) > TIME_TOLERANCE:
+        mid = (lo + hi) / 2
+        above = f(mid) >= 0
+        # a rising crossing is before `mid` when `mid` is above the horizon
+        before = np.where(rising, above, ~above)
+        hi = np.where(before, mid, hi)
+        lo = np.where(before, lo, mid)
+    return (lo + hi) / 2
+
+
+def _golden_max(f, lo, hi, iterations=25):
+    """Vectorized golden-section search for the maximum of f in [lo, hi]."""
+    g = (np.sqrt(5) - 1) / 2
+    a, b = lo.copy(), hi.copy()
+    c = b - g * (b - a)
+    d = a + g * (b - a)
+    fc, fd = f(c), f(d)
+    for _ in range(iterations):
+        left = fc > fd
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        # reuse the interior point that survived
+        c_new = np.where(left, b - g * (b - a), d)
+        d_new = np.where(left, c, a + g * (b - a))
+        fc_new = np.where(left, np.nan, fd)
+        fd_new = np.where(left, fc, np.nan)
+        need_c = np.isnan(fc_new)
+        need_d = np.isnan(fd_new)
+        c, d = c_new, d_new
+        if need_c.any():
+            fc_new[need_c] = f(c[need_c], need_c)
+        if need_d.any():
+            fd_new[need_d] = f(d[need_d], need_d)
+        fc, fd = fc_new, fd_new
+    return (a + b) / 2
+
+
+def find_passes(observers, satellite, start_time, num_passes=None,
+                duration=None):
+    """Return a list of PassTuple for one satellite over many stations.
+
+    The satellite is propagated once per time step and the elevation is
+    evaluated for all stations at each step.
+
+    Arguments:
+    observers -- sequence of station dicts (name, lat, lon, altitude,
+                 min_horizon)
+    satellite -- satellite dict with 'tle' and 'norad_cat_id'
+    start_time -- ephem.date string formatted 'yyyy/mm/dd hr:min:sec'
+    num_passes -- maximum number of passes per station (default None)
+    duration -- float number of hours (default None)
+
+    Only passes which rise inside the window are returned, a pass already
+    in progress at `start_time` is skipped just as in
+    compute_passes_ephem().
+    """
+    stations = StationArray(observers)
+    if len(stations) == 0:
+        return []
+
+    start = ephem.date(start_time)
+    start_dt = start.datetime()
+    window, max_passes = _time_limits(start_time, num_passes, duration)
+
+    eph = Ephemeris(satellite['tle'], float(start) + DJD_TO_JD)
+    step = eph.period / SAMPLES_PER_ORBIT
+    horizon = stations.horizon
+
+    def elevation(t, index):
+        return stations.look(eph.ecef(t), index)[1] - horizon[index]
+
+    nstations = len(stations)
+    counts = np.zeros(nstations, dtype=int)
+    open_rise = np.full(nstations, np.nan)  # rise time of a pass in progress
+    contacts = []
+
+    t0 = 0.0
+    while True:
+        # keep going past the window only to close passes which rose in it,
+        # and not forever for ones that don't set, those are dropped
+        if t0 > window and (np.all(np.isnan(open_rise))
+                            or t0 - window > MAX_PASS_DAYS):
+            break
+        if max_passes is not None and np.all(counts >= max_passes):
+            break
+
+        # size the chunk to the rest of the window, within the memory bound
+        nsamples = int(np.clip(np.ceil((window - t0) / step) + 1,
+                               MIN_CHUNK_SAMPLES,
+                               max(MIN_CHUNK_SAMPLES,
+                                   CHUNK_ELEMENTS // nstations)))
+        # first sample repeats the last one of the previous chunk
+        t = t0 + step * np.arange(nsamples + 1)
+        _, el = stations.look(eph.ecef(t))
+        # NaN from a failed propagation counts as below the horizon
+        up = el - horizon[:, None] >= 0
+
+        # crossings between samples i and i+1, in time order per station
+        si, ti = np.nonzero(up[:, :-1] != up[:, 1:])
+        lo = t[ti]
+        rising = up[si, ti + 1]
+
+        if len(si):
+            def fcross(tm):
+                return elevation(tm, si)
+            tc = _bisect(fcross, lo, lo + step, rising)
+        else:
+            tc = np.empty(0)
+
+        # pair up rise and set events per station, in time order
+        finished = []
+        for s, tx, rise in zip(si, tc, rising):
+            if rise:
+                if tx <= window:
+                    open_rise[s] = tx
+            elif not np.isnan(open_rise[s]):
+                if max_passes is None or counts[s] < max_passes:
+                    finished.append((s, open_rise[s], tx))
+                    counts[s] += 1
+                open_rise[s] = np.nan
+
+        if finished:
+            contacts.extend(_describe(finished, stations, satellite, eph,
+                                      start_dt, elevation, step))
+
+        t0 = t[-1]
+
+    return contacts
+
+
+def _describe(finished, stations, satellite, eph, start_dt, elevation, step):
+    """Build PassTuples for (station index, rise, set) triples."""
+    idx = np.array([s for s, _, _ in finished])
+    rise = np.array([r for _, r, _ in finished])
+    fall = np.array([f for _, _, f in finished])
+
+    def fmax(tm, mask=None):
+        i = idx if mask is None else idx[mask]
+        return elevation(tm, i)
+    tca = _golden_max(fmax, rise, fall)
+
+    times = np.concatenate((rise, fall, tca))
+    which = np.concatenate((idx, idx, idx))
+    az, el = stations.look(eph.ecef(times), which)
+    n = len(idx)
+    rise_az, set_az = az[:n], az[n:2*n]
+    max_el = el[2*n:]
+
+    data = []
+    for k, s in enumerate(idx):
+        rising = start_dt + timedelta(days=rise[k])
+        setting = start_dt + timedelta(days=fall[k])
+        pass_data = {
+            'start': rising,
+            'end': setting,
+            'duration': (setting - rising).total_seconds(),
+            'rise_az': rise_az[k] * deg_per_rad,
+            'set_az': set_az[k] * deg_per_rad,
+            'tca': start_dt + timedelta(days=tca[k]),
+            'max_el': max_el[k] * deg_per_rad,
+            'gs': stations.observers[s]['name'],
+            'norad': satellite['norad_cat_id'],
+        }
+        data.append(PassTuple(**pass_data))
+    return data
+
+
+def compute_passes_numpy(args):
+    """Config obs and sat, Return pass data for all passes in given interval.
+    uses NumPy and the sgp4 library
+
+    Drop-in replacement for db.compute_passes_ephem().  `observer` may also
+    be a sequence of station dicts, in which case the satellite is
+    propagated once and passes for all of them are returned.
+
+    Arguments:
+    observer -- station dict or sequence of station dicts
+    tle -- 3 element list containing desired tle [line0,line1,line2]
+    start_time -- ephem.date string formatted 'yyyy/mm/dd hr:min:sec'
+    num_passes -- integer number of desired passes (defualt None)
+    duration -- float number of hours or fraction of hours (default None)
+    """
+    (observer, satellite, start_time, num_passes, duration) = args
+    if isinstance(observer, Mapping):
+        observers = [observer]
+    else:
+        observers = list(observer)
+
+    return find_passes(observers, satellite, start_time,
+                       num_passes=num_passes, duration=duration)
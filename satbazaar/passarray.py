@@ -0,0 +1,271 @@
+"""`passarray` -- Compact container of passes
+=============================================
+
+An immutable, array-backed alternative to an `IntervalTree` of passes.
+Pass attributes are stored as NumPy columns sorted by start time, with times
+as integer milliseconds since the Unix epoch and ground stations dictionary
+encoded.  Overlap queries use binary search on the start times plus a
+running maximum of the end times.
+
+Iterating yields `Interval(begin, end, PassTuple)` objects built on demand,
+so code written against `db.getpasses()` trees keeps working.
+
+save() writes the columns to a directory of `.npy` files which load()
+memory-maps, so a saved PassArray opens without reading the data.
+"""
+from collections.abc import Sequence
+from datetime import datetime
+import json
+import os
+
+import numpy as np
+from intervaltree import Interval
+
+from satbazaar.db import PassTuple, to_epoch_ms, from_epoch_ms
+
+
+def _ms(t):
+    """Epoch milliseconds from a datetime, or an integer already in ms."""
+    if isinstance(t, datetime):
+        return to_epoch_ms(t)
+    return int(t)
+
+
+class PassArray(Sequence):
+    """Sorted, immutable collection of passes supporting the parts of the
+    IntervalTree API used by the schedulers.
+
+    Columns (all the same length, sorted by start then end):
+        start_ms, end_ms, tca_ms -- int64 epoch milliseconds
+        duration, rise_az, set_az, max_el -- float64
+        gs -- int32 codes into `gs_names`
+        norad -- int32
+    """
+    COLUMNS = ('start_ms', 'end_ms', 'duration', 'rise_az', 'set_az',
+               'tca_ms', 'max_el', 'gs', 'norad')
+    DTYPES = ('i8', 'i8', 'f8', 'f8', 'f8', 'i8', 'f8', 'i4', 'i4')
+    # layout of the directories written by save()
+    FILE_VERSION = 1
+
+    def __init__(self, start, end, duration, rise_az, set_az, tca, max_el,
+                 gs, norad, gs_names, presorted=False, maxend=None):
+        """Build from column arrays, see from_passes() for PassTuples.
+
+        `gs` are integer codes into the sequence `gs_names`.  `maxend` is
+        the running maximum of the end times if already known, only used
+        when `presorted`.
+        """
+        cols = [np.asarray(c, dtype=t) for c, t in zip(
+            (start, end, duration, rise_az, set_az, tca, max_el, gs, norad),
+            self.DTYPES)]
+        if not presorted:
+            order = np.lexsort((cols[1], cols[0]))
+            cols = [c[order] for c in cols]
+        for name, c in zip(self.COLUMNS, cols):
+            c.setflags(write=False)
+            setattr(self, name, c)
+        self.gs_names = tuple(gs_names)
+        # running maximum of the end times, monotonic so it can be searched
+        if presorted and maxend is not None:
+            self._maxend = np.asarray(maxend, dtype='i8')
+        else:
+            self._maxend = np.maximum.accumulate(self.end_ms)
+        self._maxend.setflags(write=False)
+
+    @classmethod
+    def from_passes(cls, passes):
+        """Build from an iterable of PassTuples or Intervals of PassTuples."""
+        data = [p.data if isinstance(p, Interval) else p for p in passes]
+        names = sorted({d.gs for d in data})
+        codes = {name: i for i, name in enumerate(names)}
+        return cls(
+            [to_epoch_ms(d.start) for d in data],
+            [to_epoch_ms(d.end) for d in data],
+            [d.duration for d in data],
+            [d.rise_az for d in data],
+            [d.set_az for d in data],
+            [to_epoch_ms(d.tca) for d in data],
+            [d.max_el for d in data],
+            [codes[d.gs] for d in data],
+            [d.norad for d in data],
+            names)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from rows in PassTuple column order with times in epoch
+        milliseconds, as from db.iterpasses(epoch_ms=True).
+        """
+        rows = list(rows)
+        if not rows:
+            return cls(*([] for _ in cls.COLUMNS), gs_names=())
+        cols = list(zip(*rows))
+        names = sorted(set(cols[7]))
+        codes = {name: i for i, name in enumerate(names)}
+        cols[7] = [codes[name] for name in cols[7]]
+        return cls(*cols, gs_names=names)
+
+    def save(self, directory):
+        """Write the columns as `.npy` files, plus `passes.json` with the
+        ground station names, into directory."""
+        os.makedirs(directory, exist_ok=True)
+        for name in self.COLUMNS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        np.save(os.path.join(directory, 'maxend_ms.npy'), self._maxend)
+        meta = {
+            'version': self.FILE_VERSION,
+            'count': len(self),
+            'gs_names': list(self.gs_names),
+            'norads': sorted(int(n) for n in np.unique(self.norad)),
+        }
+        with open(os.path.join(directory, 'passes.json'), 'w') as fp:
+            json.dump(meta, fp, indent=1)
+
+    @staticmethod
+    def load_meta(directory):
+        """Contents of passes.json in a directory written by save()."""
+        with open(os.path.join(directory, 'passes.json')) as fp:
+            meta = json.load(fp)
+        if meta.get('version') != PassArray.FILE_VERSION:
+            raise ValueError('Unknown pass array version {}'.format(
+                meta.get('version')))
+        return meta
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """PassArray of a directory written by save().  The columns are
+        memory-mapped read-only by default, mmap_mode=None reads them into
+        memory instead."""
+        meta = cls.load_meta(directory)
+
+        def column(name):
+            path = os.path.join(directory, name + '.npy')
+            if meta['count'] == 0:
+                # empty files can't be memory-mapped
+                return np.load(path)
+            return np.load(path, mmap_mode=mmap_mode)
+
+        return cls(*(column(name) for name in cls.COLUMNS),
+                   gs_names=meta['gs_names'], presorted=True,
+                   maxend=column('maxend_ms'))
+
+    def _subset(self, index):
+        """New PassArray of the rows selected by a mask, slice or sorted
+        index array."""
+        return PassArray(*(getattr(self, c)[index] for c in self.COLUMNS),
+                         gs_names=self.gs_names, presorted=True)
+
+    def passtuple(self, i):
+        """PassTuple for row i."""
+        return PassTuple(from_epoch_ms(int(self.start_ms[i])),
+                         from_epoch_ms(int(self.end_ms[i])),
+                         float(self.duration[i]),
+                         float(self.rise_az[i]),
+                         float(self.set_az[i]),
+                         from_epoch_ms(int(self.tca_ms[i])),
+                         float(self.max_el[i]),
+                         self.gs_names[self.gs[i]],
+                         int(self.norad[i]))
+
+    def interval(self, i):
+        """Interval of row i with the PassTuple as data."""
+        d = self.passtuple(i)
+        return Interval(d.start, d.end, d)
+
+    def __len__(self):
+        return len(self.start_ms)
+
+    def __getitem__(self, key):
+        """Positional index returns an Interval, slices and index arrays
+        return a PassArray.  A datetime returns the passes overlapping that
+        instant, like IntervalTree[t].
+        """
+        if isinstance(key, datetime):
+            return self.search(key)
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('PassArray index out of range')
+            return self.interval(key)
+        if isinstance(key, slice):
+            return self._subset(key)
+        key = np.asarray(key)
+        if key.dtype != bool:
+            key = np.sort(key)
+        return self._subset(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.interval(i)
+
+    def __contains__(self, iv):
+        d = iv.data if isinstance(iv, Interval) else iv
+        return any(self.passtuple(i) == d
+                   for i in self.overlap_index(d.start, d.end))
+
+    def __repr__(self):
+        return 'PassArray({} passes, {} stations)'.format(
+            len(self), len(self.gs_names))
+
+    def begin(self):
+        """Start of the earliest pass, 0 if empty like IntervalTree."""
+        if len(self) == 0:
+            return 0
+        return from_epoch_ms(int(self.start_ms[0]))
+
+    def end(self):
+        """End of the latest pass, 0 if empty like IntervalTree."""
+        if len(self) == 0:
+            return 0
+        return from_epoch_ms(int(self._maxend[-1]))
+
+    def is_empty(self):
+        return len(self) == 0
+
+    def items(self):
+        """Set of all Intervals, as IntervalTree.items()."""
+        return set(self)
+
+    def overlap_index(self, begin, end=None, strict=False):
+        """Row numbers of passes matching search(begin, end, strict)."""
+        b = _ms(begin)
+        if end is None:
+            # point query: begin <= b < end
+            hi = np.searchsorted(self.start_ms, b, side='right')
+            lo = np.searchsorted(self._maxend, b, side='right')
+            idx = np.arange(lo, hi)
+            return idx[self.end_ms[lo:hi] > b]
+
+        e = _ms(end)
+        if strict:
+            # fully enveloped: b <= begin and end <= e
+            lo = np.searchsorted(self.start_ms, b, side='left')
+            hi = np.searchsorted(self.start_ms, e, side='left')
+            idx = np.arange(lo, hi)
+            return idx[self.end_ms[lo:hi] <= e]
+
+        # overlapping: begin < e and end > b
+        hi = np.searchsorted(self.start_ms, e, side='left')
+        lo = np.searchsorted(self._maxend, b, side='right')
+        idx = np.arange(lo, max(lo, hi))
+        return idx[self.end_ms[lo:max(lo, hi)] > b]
+
+    def search(self, begin, end=None, strict=False):
+        """Passes overlapping the point `begin` or the range [begin, end),
+        or only those enveloped by the range if `strict`.  Same semantics as
+        IntervalTree.search() but returns a PassArray.
+        """
+        return self._subset(self.overlap_index(begin, end, strict))
+
+    def filter(self, gs=None, norad=None):
+        """PassArray of the passes of one ground station name and/or
+        satellite number."""
+        mask = np.ones(len(self), dtype=bool)
+        if gs is not None:
+            if gs not in self.gs_names:
+                mask[:] = False
+            else:
+                mask &= self.gs == self.gs_names.index(gs)
+        if norad is not None:
+            mask &= self.norad == norad
+        return self._subset(mask)
@@ -1,13 +1,51 @@
 # This file contains the different scheduling method definitions to be used
 # when simulating.
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from collections.abc import Mapping
+import copy
+import itertools
+import multiprocessing
 import random
 
 from intervaltree import IntervalTree
 
 
+def partition_passes(passes):
+    """Split passes into {gs: passes of that GS}.
+
+    A PassArray is split into PassArrays, anything else into IntervalTrees,
+    so schedulers can use the same calls on a partition.
+    """
+    if hasattr(passes, 'filter'):
+        return {gs: passes.filter(gs=gs) for gs in passes.gs_names}
+    bygs = defaultdict(list)
+    for pd in passes:
+        bygs[pd.data.gs].append(pd)
+    return {gs: IntervalTree(gspasses) for gs, gspasses in bygs.items()}
+
+
+def _run_partition(args):
+    """Schedule one GS's passes, in a worker process."""
+    gs, scheduler, passes, batch_size, seed = args
+    random.seed(seed)
+    scheduler.run(passes, batch_size)
+    return gs, scheduler.clients[gs].calendar
+
+
 class Scheduler:
-    """Base class for schedulers.  Inherit and implement __call__."""
+    """Base class for schedulers.  Inherit and implement __call__.
+
+    Set partitionable to False if the passes of one GS affect what is
+    requested on another, run_partitioned() then runs unpartitioned.
+
+    With run(passes, batch_size) requests are queued per GS and sent with
+    the client's request_batch() every batch_size requests, and the offers
+    are only known after the batch is sent.
+    """
+    partitionable = True
+    batch_size = None
+
     def __init__(self, clients, satellites, passes=None, debug=False):
         """Store dicts of clients and satellites for use later.
         Do the scheduling if passes is given.
@@ -16,16 +54,106 @@ class Scheduler:
         self.satellites = satellites
         self.passes = passes
         self.debug = debug
+        self.job_ids = itertools.count(1)
+        self._queues = defaultdict(list)
         if passes is not None:
             self(passes)
 
     def __call__(self, passes):
         raise NotImplementedError
 
-    def do_request(self, pd):
-        """Helper to take a PassTuple and make a request to the relevant client."""
-        r = pass2request(pd, self.satellites)
-        offer = self.clients[pd.data.gs].request(r)
+    def run(self, passes, batch_size=None):
+        """Schedule the passes, in batches per GS if batch_size is given.
+
+        Returns the clients.
+        """
+        self.batch_size = batch_size
+        try:
+            self(passes)
+            self.flush()
+        finally:
+            self.batch_size = None
+        return self.clients
+
+    def flush(self, gs=None):
+        """Send the queued requests of one or all GSs, returns the offers."""
+        offers = []
+        for name in ([gs] if gs is not None else list(self._queues)):
+            requests = self._queues.pop(name, [])
+            if requests:
+                offers.extend(self.clients[name].request_batch(requests))
+        if self.debug:
+            for offer in offers:
+                print('*' if offer['status'] == 'accept' else '.',
+                      end='', flush=True)
+        return offers
+
+    def run_partitioned(self, passes, num_processes=None, chunksize=1,
+                        batch_size=None):
+        """Schedule the passes of each GS independently in a process pool.
+
+        Ground stations don't interact, so each worker gets a copy of this
+        scheduler with only the GS's client and the satellites it sees, and
+        the resulting calendars are put back into self.clients.  Job IDs
+        of partition k start at k * 2**32 + 1, and its `random` is seeded
+        with k plus a base drawn once from this process's `random`, so
+        RandomScheduler gives the same result after random.seed() however
+        many processes run the partitions.  Uses os.cpu_count()
+        processes by default, or runs in this process if num_processes
+        is 1.  The scheduler has to be picklable, e.g. no
+        lambda as a MaxWeightScheduler weight.  batch_size is as for run().
+        """
+        if not self.partitionable:
+            return self.run(passes, batch_size)
+
+        jobs = []
+        for gs, gspasses in partition_passes(passes).items():
+            if len(gspasses) == 0:
+                continue
+            part = copy.copy(self)
+            part.clients = {gs: self.clients[gs]}
+            norads = {pd.data.norad for pd in gspasses}
+            part.satellites = {norad: self.satellites[norad]
+                               for norad in norads}
+            part.passes = None
+            part._queues = defaultdict(list)
+            jobs.append((gs, part, gspasses, batch_size))
+        # biggest first so a long partition doesn't start last
+        jobs.sort(key=lambda job: len(job[2]), reverse=True)
+        base = random.getrandbits(32)
+        for k, job in enumerate(jobs):
+            job[1].job_ids = itertools.count(k * 2**32 + 1)
+        jobs = [job + (base + k,) for k, job in enumerate(jobs)]
+
+        if num_processes == 1:
+            # clients are updated in place, the seeding mustn't leak out
+            state = random.getstate()
+            for job in jobs:
+                _run_partition(job)
+            random.setstate(state)
+            return self.clients
+
+        with multiprocessing.Pool(num_processes) as pool:
+            results = pool.imap_unordered(_run_partition, jobs, chunksize)
+            for gs, calendar in results:
+                self.clients[gs].calendar = calendar
+        return self.clients
+
+    def do_request(self, pd, r=None):
+        """Helper to take a PassTuple and make a request to the relevant client.
+        The request is built from the pass unless given.
+
+        In batch mode the request is queued and None returned."""
+        if r is None:
+            r = pass2request(pd, self.satellites, next(self.job_ids))
+        if self.batch_size:
+            queue = self._queues[pd.data.gs]
+            queue.append(r)
+            if len(queue) >= self.batch_size:
+                self.flush(pd.data.gs)
+            return None
+        # hand over the native times so the client skips parsing the job
+        offer = self.clients[pd.data.gs].request_times(r, pd.begin, pd.end)
         if self.debug:
             if offer['status'] == 'accept':
                 print('*', end='', flush=True)
@@ -65,8 +193,54 @@ class DurationScheduler(Scheduler):
 
 
 class EndStartScheduler(Scheduler):
-    """Should be exactly the same result as FirstScheduler.
-    Here just as an example of using features of the passes IntervalTree class."""
+    """Request the earliest starting pass, then the earliest one starting
+    after it ends, and so on, across all GSs.
+
+    A single sweep over the passes sorted by start.  Passes starting at the
+    same time are ordered by tiebreak: 'end' (earliest finish), 'max_el'
+    (highest), 'duration' (longest), 'bounty' (largest) or a key function of
+    the pass, lowest first.
+
+    Steps through time across all GSs, so it can't be partitioned by GS."""
+    partitionable = False
+
+    TIEBREAKS = {
+        'end': lambda p: p.end,
+        'max_el': lambda p: -p.data.max_el,
+        'duration': lambda p: p.begin - p.end,
+        'bounty': lambda p: -sum(pass_bounty(p).values()),
+    }
+
+    def __init__(self, clients, satellites, tiebreak='end', passes=None,
+                 debug=False):
+        self.tiebreak = tiebreak
+        super().__init__(clients, satellites, passes=passes, debug=debug)
+
+    def _tiebreak_key(self):
+        if callable(self.tiebreak):
+            return self.tiebreak
+        return self.TIEBREAKS[self.tiebreak]
+
+    def __call__(self, passes):
+        tiebreak = self._tiebreak_key()
+        s = sorted(passes, key=lambda p: (p.begin, tiebreak(p)))
+        begins = [pd.begin for pd in s]
+        i = 0
+        while i < len(s):
+            pd = s[i]
+            self.do_request(pd)
+            # next pass starting at or after the end of this one
+            i = bisect_left(begins, pd.end, i + 1)
+
+
+class EndStartSearchScheduler(Scheduler):
+    """Reference implementation of EndStartScheduler using features of the
+    passes IntervalTree class.  Searches and sorts the remaining passes for
+    every request, so it is only usable on small sets of passes.
+
+    Passes starting at the same time are taken in arbitrary order."""
+    partitionable = False
+
     def __call__(self, passes):
         now = passes.begin()
         last = passes.end()
@@ -80,101 +254,326 @@ class EndStartScheduler(Scheduler):
             now = pd.end
 
 
-class OwnerPreferenceScheduler(Scheduler):
-    """Select passes based on list of sats sorted by priority."""
-    def __init__(self, clients, satellites, priority={}, passes=None, debug=False):
+def max_weight_selection(passes, weights):
+    """Indices of the non-overlapping subset of passes with the largest total
+    weight, in order of end time.
+
+    Weighted interval scheduling: sort by end, find each pass's last
+    compatible predecessor with bisect, then dynamic programming and a
+    backtrack, O(n log n).
+    """
+    order = sorted(range(len(passes)),
+                   key=lambda k: (passes[k].end, passes[k].begin))
+    ends = [passes[k].end for k in order]
+
+    # best[j] is the largest total weight using the first j passes,
+    # pred[j] how many passes end before pass j begins
+    best = [0] * (len(order) + 1)
+    pred = [0] * len(order)
+    for j, k in enumerate(order):
+        pred[j] = bisect_right(ends, passes[k].begin, 0, j)
+        best[j + 1] = max(best[j], weights[k] + best[pred[j]])
+
+    chosen = []
+    j = len(order)
+    while j > 0:
+        if best[j] == best[j - 1]:
+            j -= 1
+        else:
+            chosen.append(order[j - 1])
+            j = pred[j - 1]
+    chosen.reverse()
+    return chosen
+
+
+class MaxWeightScheduler(Scheduler):
+    """Request the set of non-overlapping passes with the largest total weight
+    on each GS, found exactly by weighted interval scheduling.
+
+    Only the selected passes are requested, so a YesClient accepts all of
+    them.  This gives the best possible result to compare the greedy
+    schedulers against.
+
+    weight is 'duration' (seconds), 'bounty' (total amount of the request's
+    bounty in `currency`) or a function of the pass returning a number.
+    """
+    def __init__(self, clients, satellites, weight='duration', currency='SNC',
+                 passes=None, debug=False):
+        self.weight = weight
+        self.currency = currency
+        super().__init__(clients, satellites, passes=passes, debug=debug)
+
+    def _weight(self, pd):
+        if self.weight == 'duration':
+            return (pd.end - pd.begin).total_seconds()
+        if self.weight == 'bounty':
+            bounty = pass_bounty(pd)
+            if self.currency not in bounty:
+                raise ValueError(
+                    'Unknown bounty currency: {!r}'.format(self.currency))
+            return bounty[self.currency]
+        return self.weight(pd)
+
+    def select(self, passes):
+        """Return the chosen passes of one GS, by start time."""
+        passes = list(passes)
+        weights = [self._weight(pd) for pd in passes]
+        return [passes[k] for k in max_weight_selection(passes, weights)]
+
+    def __call__(self, passes):
+        bygs = defaultdict(list)
+        for pd in passes:
+            bygs[pd.data.gs].append(pd)
+
+        # job IDs only go to the requests actually made
+        for gs, gspasses in bygs.items():
+            for pd in self.select(gspasses):
+                self.do_request(pd)
+
+
+class Taken:
+    """Passes taken on one GS, sorted and non-overlapping, so overlap checks
+    are a binary search."""
+    def __init__(self):
+        self.begins = []
+        self.ends = []
+        self.passes = []
+
+    def overlaps(self, pd):
+        i = bisect_right(self.begins, pd.begin)
+        return ((i > 0 and self.ends[i - 1] > pd.begin)
+                or (i < len(self.begins) and self.begins[i] < pd.end))
+
+    def take(self, pd):
+        """Add the pass unless it overlaps one already taken, returns whether
+        it was added."""
+        if self.overlaps(pd):
+            return False
+        i = bisect_right(self.begins, pd.begin)
+        self.begins.insert(i, pd.begin)
+        self.ends.insert(i, pd.end)
+        self.passes.insert(i, pd)
+        return True
+
+    def __len__(self):
+        return len(self.passes)
+
+
+class PriorityStage:
+    """Take the passes of each GS's priority satellites, in order of
+    priority, unless they overlap a pass of a higher priority satellite.
+
+    priority is {gs: (norad, ...)} with the highest priority first.  Passes
+    of the priority satellites which weren't taken are dropped.
+    """
+    def __init__(self, priority):
         self.priority = priority
+
+    def __call__(self, gs, passes, taken):
+        rank = {norad: i for i, norad in enumerate(self.priority.get(gs, ()))}
+        ranked = sorted((pd for pd in passes if pd.data.norad in rank),
+                        key=lambda p: (rank[p.data.norad], p.begin))
+        for pd in ranked:
+            taken.take(pd)
+        return [pd for pd in passes if pd.data.norad not in rank]
+
+
+class FirstStage:
+    """Take the remaining passes in order of start time."""
+    def __call__(self, gs, passes, taken):
+        for pd in passes:
+            taken.take(pd)
+        return []
+
+
+class MaxWeightStage:
+    """Take the non-overlapping remaining passes with the largest total
+    weight, a function of the pass (default duration in seconds)."""
+    def __init__(self, weight=None):
+        self.weight = weight
+
+    def __call__(self, gs, passes, taken):
+        if self.weight is None:
+            weights = [(pd.end - pd.begin).total_seconds() for pd in passes]
+        else:
+            weights = [self.weight(pd) for pd in passes]
+        for k in max_weight_selection(passes, weights):
+            taken.take(passes[k])
+        return [pd for pd in passes if not taken.overlaps(pd)]
+
+
+class SchedulerPipeline(Scheduler):
+    """Chain of stages deciding which passes of each GS to request.
+
+    A stage is called as stage(gs, passes, taken) with the GS's remaining
+    passes sorted by start and its Taken passes.  It moves the passes it
+    chooses into taken and returns the ones left for the next stage; passes
+    overlapping a taken pass are dropped before the next stage runs.  The
+    taken passes and whatever is left after the last stage are requested in
+    order of start time, so the client decides about remaining overlaps.
+
+    For example (PriorityStage(priority), MaxWeightStage()) gives owners'
+    satellites precedence and fills the gaps optimally.
+    """
+    def __init__(self, clients, satellites, stages=(), passes=None,
+                 debug=False):
+        self.stages = list(stages)
         super().__init__(clients, satellites, passes=passes, debug=debug)
 
+    def select(self, gs, passes):
+        """Passes of one GS to request, sorted by start."""
+        candidates = sorted(passes, key=lambda p: p.begin)
+        taken = Taken()
+        for stage in self.stages:
+            candidates = stage(gs, candidates, taken)
+            candidates = [pd for pd in candidates if not taken.overlaps(pd)]
+        return sorted(taken.passes + candidates, key=lambda p: p.begin)
+
     def __call__(self, passes):
-        # go down list of priority sats
-        # if in passes, schedule it
-        # remove all overlapping passes
-
-        # construct separate trees for individual GSs
-        gstree = {gs:IntervalTree() for gs in self.priority.keys()}
-        othertree = IntervalTree()
-        sattree = {gs:defaultdict(list) for gs in self.priority.keys()}
+        bygs = defaultdict(list)
         for pd in passes:
-            if pd.data.gs in gstree:
-                gstree[pd.data.gs].add(pd)
-                # easy access to participating sats
-                sattree[pd.data.gs][pd.data.norad].append(pd)
-            else:
-                othertree.add(pd)
-
-        # collapse the trees by priority
-        for gs, tree in gstree.items():
-            for norad in self.priority[gs]:
-                # remove passes which overlap with a priority sat's pass
-                # Alternate is to first request these passes, then let the
-                # Client reject later requests which overlap, but this would
-                # burn much network overhead.
-                for pd in sattree[gs][norad]:
-                    # pass could have already been removed, so check first
-                    if pd in tree:
-                        tree.remove_overlap(pd)
-                        # add back the pass in question
-                        tree.add(pd)
-
-        # TODO: have a hierarchy of Schedulers
-        #       what should the strategy be for the remaining overlaps?
-        #
-        # Each scheduler in the list runs in order.
-        # Passes remaining (not scheduled and also not removed by earlier) are
-        # sent to the following scheduler.
-        #   ( OwnerPreferenceScheduler(config),
-        #     NextScheduler(config2),
-        #     FinalScheduler(config3),
-        #   )
-
-        # TODO: idea
-        #   Each of these operates as a filter to deal with overlaps.
-        #   maybe use own version of IntervalTree.merge_overlaps(datafunc)
-
-        # Schedule passes on GSs without priorities by first start
-        for pd in sorted(othertree, key=lambda p: p.begin):
-            self.do_request(pd)
+            bygs[pd.data.gs].append(pd)
 
-        # Schedule passes on GS with preferences using the pruned trees
-        for gs, tree in gstree.items():
-            for pd in sorted(tree, key=lambda p: p.begin):
+        for gs, gspasses in bygs.items():
+            for pd in self.select(gs, gspasses):
                 self.do_request(pd)
 
 
+class OwnerPreferenceScheduler(SchedulerPipeline):
+    """Select passes based on list of sats sorted by priority.
+
+    Passes overlapping those of a priority sat are dropped, the rest are
+    requested by first start.
+    """
+    def __init__(self, clients, satellites, priority={}, passes=None, debug=False):
+        self.priority = priority
+        super().__init__(clients, satellites,
+                         stages=(PriorityStage(priority),),
+                         passes=passes, debug=debug)
+
+
+
 
 
 
+_job_ids = itertools.count(1)
 
-def pass2request(pd, satellites):
-    """Take a pass (as returned from db.getpasses() and construct a request
-    dict for the Network to send to a Client.
 
-    The bounty is SNC (SatNOGS Credits) with an amount set to the pass duration
-    in seconds.
+class Job(Mapping):
+    """The job of a Request.  Reads like the JSON job dict, the values are
+    made when accessed: 'start' and 'end' are ISO 8601 strings (the start
+    and end attributes are datetimes) and the TLE lines are looked up in
+    satellites by norad.
+    """
+    __slots__ = ('id', 'start', 'end', 'ground_station', 'norad', 'satellites')
+
+    KEYS = ('id', 'start', 'end', 'ground_station', 'tle0', 'tle1', 'tle2',
+            'frequency', 'mode', 'transmitter')
+    FIXED = {'frequency': -1,
+             'mode': 'null',
+             'transmitter': 'asdfasdasdfadsf',
+             }
+    TLE_LINES = {'tle0': 0, 'tle1': 1, 'tle2': 2}
+
+    def __init__(self, id, start, end, ground_station, norad, satellites):
+        self.id = id
+        self.start = start
+        self.end = end
+        self.ground_station = ground_station
+        self.norad = norad
+        self.satellites = satellites
 
-    When transmitted over a network, this is then converted to JSON.
+    def __getitem__(self, key):
+        if key == 'id':
+            return self.id
+        if key == 'start':
+            return self.start.isoformat()
+        if key == 'end':
+            return self.end.isoformat()
+        if key == 'ground_station':
+            return self.ground_station
+        if key in self.TLE_LINES:
+            return self.satellites[self.norad]['tle'][self.TLE_LINES[key]]
+        return self.FIXED[key]
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return 'Job(id={}, start={}, end={}, ground_station={!r}, norad={})'.format(
+            self.id, self.start, self.end, self.ground_station, self.norad)
+
+
+class Request(Mapping):
+    """Request for a Job with a bounty, read like the JSON request dict
+    r['job'], r['bounty'] and r['status'].  Use to_dict() for the plain dict
+    when the request is sent out.
     """
+    __slots__ = ('job', 'amount', 'currency', 'status')
+
+    KEYS = ('job', 'bounty', 'status')
+
+    def __init__(self, job, amount, currency='SNC', status='initial'):
+        self.job = job
+        self.amount = amount
+        self.currency = currency
+        self.status = status
+
+    def __getitem__(self, key):
+        if key == 'job':
+            return self.job
+        if key == 'bounty':
+            return [{'currency': self.currency, 'amount': self.amount}]
+        if key == 'status':
+            return self.status
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return 'Request({!r}, amount={}, currency={!r}, status={!r})'.format(
+            self.job, self.amount, self.currency, self.status)
+
+    def to_dict(self):
+        """The request as nested dicts and lists, ready for JSON."""
+        return {'job': dict(self.job),
+                'bounty': self['bounty'],
+                'status': self.status,
+                }
 
-    d = pd.data
-    job = {'id': random.randrange(2**16),  # fake an ID number
-           'start': d.start.isoformat(),
-           'end': d.end.isoformat(),
-           'ground_station': d.gs,
-           'tle0': satellites[d.norad]['tle'][0],
-           'tle1': satellites[d.norad]['tle'][1],
-           'tle2': satellites[d.norad]['tle'][2],
-           'frequency': -1,
-           'mode': 'null',
-           'transmitter': 'asdfasdasdfadsf',
-           }
-    duration = (d.end - d.start).total_seconds()
-    bounty = [{'currency': 'SNC', 'amount': duration}]
-
-    request = {'job': job,
-               'bounty': bounty,
-               'status': 'initial',
-               }
-    return request
 
+def pass_bounty(pd):
+    """{currency: amount} of the bounty pass2request() puts on a pass,
+    without making the Request so no job ID is used up.
 
+    The bounty is SNC (SatNOGS Credits) with an amount set to the pass
+    duration in seconds.
+    """
+    return {'SNC': (pd.data.end - pd.data.start).total_seconds()}
+
+
+def pass2request(pd, satellites, job_id=None):
+    """Take a pass (as returned from db.getpasses() and construct a Request
+    for the Network to send to a Client.
+
+    The bounty is the one from pass_bounty().
+
+    Job IDs increase from 1 for each request made unless job_id is given.
+
+    When transmitted over a network, this is then converted to JSON with
+    Request.to_dict().
+    """
+
+    d = pd.data
+    if job_id is None:
+        job_id = next(_job_ids)
+    job = Job(job_id, d.start, d.end, d.gs, d.norad, satellites)
+    (currency, amount), = pass_bounty(pd).items()
+    return Request(job, amount, currency)
@@ -0,0 +1,187 @@
+"""`visibility` -- Geometric prefilter of station--satellite pairs
+================================================================
+
+Classifies a pair, before any pass search, from the orbit in the TLE and
+the station's latitude and minimum elevation:
+
+    NEVER  -- the satellite can't get above min_horizon, e.g. a
+              low-inclination orbit seen from high latitude, or a
+              geostationary satellite on the far side of the Earth
+    ALWAYS -- a geostationary satellite which stays above min_horizon for
+              the whole window
+    SEARCH -- anything else, the pass search has to run
+
+Neither NEVER nor ALWAYS pairs have a rise or set in the window, so the
+pass finders return nothing for them and the search can be skipped.  The
+bounds use a spherical Earth plus a safety margin in degrees, so a pair is
+only ruled out when it clearly can't have passes.
+
+The orbit summaries are cached per TLE epoch:
+
+    vf = VisibilityFilter()
+    stations_to_search = vf.visible_stations(stations, satellite, start, end)
+"""
+from collections import Counter, namedtuple
+from math import acos, asin, cos, degrees, pi, radians, sin, sqrt
+
+import ephem
+
+from satbazaar.db import TLE
+
+
+NEVER = 'never'
+ALWAYS = 'always'
+SEARCH = 'search'
+
+# km^3/s^2, WGS-72 as used by SGP4
+EARTH_MU = 398600.8
+# WGS-84 ellipsoid, km
+EARTH_RADIUS = 6378.137
+EARTH_POLAR_RADIUS = 6356.752
+
+# revolutions per day of a geostationary orbit
+SIDEREAL_DAY_REVS = 1.00273791
+
+# orbit summaries kept, by (norad, epoch)
+CACHE_SIZE = 100000
+
+
+OrbitSummary = namedtuple(
+    'OrbitSummary',
+    'inclination perigee apogee eccentricity drift sublat sublong epoch')
+OrbitSummary.__doc__ = """Orbit of a TLE reduced to what the prefilter needs.
+
+inclination -- degrees, folded into [0, 90] for retrograde orbits
+perigee, apogee -- geocentric radius in km
+drift -- geostationary longitude drift in degrees per day
+sublat, sublong -- sub-satellite point in degrees at epoch, None unless the
+                   orbit is near geostationary
+epoch -- naive UTC datetime of the TLE epoch
+"""
+
+
+def orbit_summary(tle):
+    """OrbitSummary from a 3 line TLE."""
+    t = TLE(tle)
+    inclination = t.inclination if t.inclination <= 90 else 180 - t.inclination
+    # semi-major axis from the mean motion
+    n = t.mean_motion * 2 * pi / 86400
+    a = (EARTH_MU / n**2) ** (1 / 3)
+    e = t.eccentricity
+
+    body = ephem.readtle(*tle)
+    epoch = ephem.date(body._epoch)
+    sublat = sublong = None
+    drift = (t.mean_motion - SIDEREAL_DAY_REVS) * 360
+    if abs(t.mean_motion - SIDEREAL_DAY_REVS) < 0.05 and e < 0.05:
+        body.compute(epoch)
+        sublat = degrees(body.sublat)
+        sublong = degrees(body.sublong)
+    return OrbitSummary(inclination, a * (1 - e), a * (1 + e), e, drift,
+                        sublat, sublong, epoch.datetime())
+
+
+def station_radius(station):
+    """Geocentric radius of a station in km, from its latitude and
+    altitude in meters."""
+    phi = radians(float(station['lat']))
+    a2 = EARTH_RADIUS**2
+    b2 = EARTH_POLAR_RADIUS**2
+    r = sqrt((a2**2 * cos(phi)**2 + b2**2 * sin(phi)**2)
+             / (a2 * cos(phi)**2 + b2 * sin(phi)**2))
+    return r + float(station['altitude']) / 1000
+
+
+def max_central_angle(r, station_r, min_el):
+    """Largest Earth central angle in degrees between a station at radius
+    station_r and a satellite at radius r seen at min_el degrees or
+    higher, negative if it can't be seen at all."""
+    h = radians(min_el)
+    x = station_r * cos(h) / r
+    if x >= 1:
+        return -90.0
+    return degrees(acos(x) - h)
+
+
+def central_angle(lat1, lon1, lat2, lon2):
+    """Great circle angle in degrees between two points."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    d = (sin((lat2 - lat1) / 2)**2
+         + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2)**2)
+    return degrees(2 * asin(min(1.0, sqrt(d))))
+
+
+class VisibilityFilter:
+    """Classifies station--satellite pairs as NEVER, ALWAYS or SEARCH.
+
+    margin -- degrees added to every bound before ruling out a search,
+              covering the spherical Earth, geodetic latitude and the
+              perturbations SGP4 adds to the mean elements
+    counts -- Counter of the classifications made
+    """
+    def __init__(self, margin=2.0):
+        self.margin = margin
+        self.counts = Counter()
+        self._orbits = {}
+
+    def orbit(self, satellite):
+        """OrbitSummary of a satellite dict, cached per TLE epoch."""
+        tle = satellite['tle']
+        key = (tle[1][2:7], tle[1][18:32])
+        summary = self._orbits.get(key)
+        if summary is None:
+            if len(self._orbits) >= CACHE_SIZE:
+                self._orbits.clear()
+            summary = self._orbits[key] = orbit_summary(tle)
+        return summary
+
+    def classify(self, station, satellite, start=None, end=None):
+        """NEVER, ALWAYS or SEARCH for passes of satellite over station
+        between the naive UTC datetimes start and end.  Geostationary
+        satellites are only ruled out when the window is given, since they
+        drift."""
+        o = self.orbit(satellite)
+        r = station_radius(station)
+        min_el = float(station['min_horizon'])
+        reach = max_central_angle(o.apogee, r, min_el)
+
+        # the ground track stays within the inclination of the equator
+        if abs(float(station['lat'])) - o.inclination - reach > self.margin:
+            return self._count(NEVER)
+
+        if o.sublong is None or start is None or end is None:
+            return self._count(SEARCH)
+
+        # how far the sub-satellite point can wander from where it was at
+        # epoch: the daily figure-8 of an inclined or eccentric orbit, plus
+        # the longitude drift up to the far end of the window
+        days = max(abs((t - o.epoch).total_seconds()) / 86400
+                   for t in (start, end))
+        wander = (2 * o.inclination + 2 * degrees(o.eccentricity)
+                  + abs(o.drift) * days)
+        psi = central_angle(float(station['lat']), float(station['lon']),
+                            o.sublat, o.sublong)
+        if psi - wander - reach > self.margin:
+            return self._count(NEVER)
+        if max_central_angle(o.perigee, r, min_el) - psi - wander > self.margin:
+            return self._count(ALWAYS)
+        return self._count(SEARCH)
+
+    def _count(self, result):
+        self.counts[result] += 1
+        return result
+
+    def visible_stations(self, stations, satellite, start=None, end=None):
+        """The stations of a sequence for which the pass search has to run."""
+        return [gs for gs in stations
+                if self.classify(gs, satellite, start, end) == SEARCH]
+
+    def clear(self):
+        """Forget the cached orbits and reset the counts."""
+        self._orbits.clear()
+        self.counts.clear()
+
+
+# shared by db.compute_all_passes() and db.update_passes(), so the orbits
+# stay cached between calls
+default_filter = VisibilityFilter()